@@ -5,9 +5,12 @@ Process macro batches of data in a pipelined fashion.
 import logging
 
 from glob import glob
+from collections import deque
 import functools
 import gzip
-from multiprocessing import Pool, Value
+import itertools
+from hashlib import sha1
+from multiprocessing import Pool, cpu_count
 import numpy as np
 import os
 import tarfile
@@ -18,157 +21,743 @@ from neon.util.compat import range, StringIO
 from neon.util.persist import load_obj, save_obj
 from neon.util.argparser import NeonArgparser
 
+from class_taxonomy import ClassTaxonomy
+
 """
 Example command:
 python batch_writer.py --data_dir ~/nervana/data/NABirds_batchs --dataset_dir ~/NABirds
 """
-# Initialize global mean values so multiple processes can update them async.
-r, g, b = Value('d', 0), Value('d', 0), Value('d', 0)
+# Indexed macrobatch layout: header, uint32 labels, then either a uint64 offset table followed
+# by the concatenated JPEGs or the pre-decoded uint8 (N, H, W, C) images. Sections start on 8
+# byte boundaries so every part of the file can be memory mapped.
+INDEXED_HEADER = struct.Struct('<4sIIIII')  # magic, version, num_imgs, height, width, channels
+INDEXED_VERSION = 1
+JPEG_MAGIC = b'TXJB'
+RAW_MAGIC = b'TXRB'
+
+def _align(offset, alignment=8):
+    return -(-offset // alignment) * alignment
+
+class IndexedMacrobatch(object):
+    """
+    Memory mapped view of a macrobatch written in the 'indexed' or 'raw' format. Records are
+    sliced out of the file on demand without reading the rest of the macrobatch.
+
+    Attributes:
+        labels (ndarray): uint32 label of each record
+        images (ndarray): (N, H, W, C) uint8 images of a 'raw' macrobatch, None otherwise
+    """
+    def __init__(self, fname):
+        with open(fname, 'rb') as f:
+            magic, version, num_imgs, h, w, c = INDEXED_HEADER.unpack(f.read(INDEXED_HEADER.size))
+        assert magic in (JPEG_MAGIC, RAW_MAGIC) and version == INDEXED_VERSION, fname
+        self.labels = np.memmap(fname, dtype=np.uint32, mode='r', offset=INDEXED_HEADER.size,
+                                shape=(num_imgs,))
+        table_start = _align(INDEXED_HEADER.size + 4 * num_imgs)
+        self.images = None
+        if magic == RAW_MAGIC:
+            self.images = np.memmap(fname, dtype=np.uint8, mode='r', offset=table_start,
+                                    shape=(num_imgs, h, w, c))
+        else:
+            self.offsets = np.memmap(fname, dtype=np.uint64, mode='r', offset=table_start,
+                                     shape=(num_imgs + 1,))
+            self.data = np.memmap(fname, dtype=np.uint8, mode='r',
+                                  offset=table_start + 8 * (num_imgs + 1))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, i):
+        """ Returns the JPEG bytes (or decoded image) of record i as a view into the file """
+        if self.images is not None:
+            return self.images[i]
+        return self.data[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+# Bump when the manifest layout changes so old manifests are ignored
+MANIFEST_VERSION = 2
+
+def channel_stats(im):
+    """
+    Pixel count, per channel mean and per channel sum of squared deviations from that mean of
+    an image. Centered sums keep the merged variance exact without catastrophic cancellation.
+    """
+    x = np.asarray(im.convert('RGB'), dtype=np.float64).reshape(-1, 3)
+    mean = x.mean(axis=0)
+    return x.shape[0], mean, ((x - mean) ** 2).sum(axis=0)
+
+def merge_stats(stats):
+    """
+    Merges (count, mean, M2) channel statistics with the parallel algorithm of Chan et al.
+    Returns the combined (count, mean, M2); the variance is M2 / count.
+    """
+    n = np.array([st[0] for st in stats], dtype=np.float64)[:, None]
+    means = np.array([st[1] for st in stats], dtype=np.float64)
+    total = n.sum()
+    mean = (n * means).sum(axis=0) / total
+    m2 = np.sum([st[2] for st in stats], axis=0) + (n * (means - mean) ** 2).sum(axis=0)
+    return total, mean, m2
+
+# Draft decoding keeps at least this much oversampling before the final resampling filter, and
+# a sampled check rejects it if the output drifts below DRAFT_MIN_PSNR dB from the full decode
+REDUCING_GAP = 2
+DRAFT_MIN_PSNR = 35.0
+
+def psnr(a, b):
+    mse = np.mean((np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)) ** 2)
+    return np.inf if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+def bbox_region(size, bbox, pad):
+    """
+    Square (left, upper, right, lower) region centered on an (x, y, width, height) box, grown
+    by pad of its longest side and shifted to stay inside an image of the given size.
+    """
+    side = min(max(bbox[2], bbox[3]) * (1 + pad), min(size))
+    cx, cy = bbox[0] + bbox[2] / 2.0, bbox[1] + bbox[3] / 2.0
+    left = min(max(cx - side / 2.0, 0), size[0] - side)
+    upper = min(max(cy - side / 2.0, 0), size[1] - side)
+    return (left, upper, left + side, upper + side)
+
+def _reduce(im, factor):
+    if hasattr(im, 'reduce'):
+        return im.reduce(factor)
+    return im.resize((im.size[0] // factor, im.size[1] // factor), PILImage.BOX)
+
+def resize_img(im, target_size, squarecrop, draft=False, bbox=None, bbox_pad=0.2):
+    """
+    Scales the short side of im (or of the square region around bbox) to target_size.
+
+    With draft the JPEG is decoded at the smallest DCT scale which is still at least as large
+    as the output, and then box reduced to within REDUCING_GAP of it before the final filter.
+    The output geometry is the same as without draft.
+    """
+    region = (0, 0) + im.size if bbox is None else bbox_region(im.size, bbox, bbox_pad)
+    rsize = (region[2] - region[0], region[3] - region[1])
+    scale_factor = target_size / np.float32(min(rsize))
+    (wnew, hnew) = map(lambda x: int(round(scale_factor * x)), rsize)
+    if draft and scale_factor < 1:
+        full_size = im.size
+        im.draft(im.mode, tuple(int(np.ceil(scale_factor * x)) for x in full_size))
+        region = [c * im.size[k % 2] / float(full_size[k % 2]) for k, c in enumerate(region)]
+    if bbox is not None:
+        im = im.crop(tuple(int(round(c)) for c in region))
+    if draft:
+        factor = int(min(im.size) / (REDUCING_GAP * np.float32(min(wnew, hnew))))
+        if factor > 1:
+            im = _reduce(im, factor)
+    if im.size != (wnew, hnew):
+        filt = PILImage.BICUBIC if wnew > im.size[0] else PILImage.ANTIALIAS
+        im = im.resize((wnew, hnew), filt)
+
+    if squarecrop is True:
+        (cx, cy) = map(lambda x: (x - target_size) // 2, (wnew, hnew))
+        im = im.crop((cx, cy, cx+target_size, cy+target_size))
+    return im
 
 # NOTE: We have to leave this helper function out of the class to use multiprocess pool.map
-def proc_img(target_size, squarecrop, is_string=False, compute_global=False, imgfile=None, ):
+def proc_img(target_size, squarecrop, is_string=False, compute_global=False, decode=False,
+             mean_image=False, draft=False, bbox_pad=0.2, imgfile=None, bbox=None):
+    """
+    Returns the resized image as JPEG bytes (a uint8 array if decode). If compute_global it is
+    paired with its channel_stats, and also its pixels if mean_image.
+    """
     imgfile = StringIO(imgfile) if is_string else imgfile
     im = PILImage.open(imgfile)
 
-    scale_factor = target_size / np.float32(min(im.size))
-    if scale_factor == 1 and im.size[0] == im.size[1] and is_string is False:
-        return np.fromfile(imgfile, dtype=np.uint8)
+    if (target_size == min(im.size) and im.size[0] == im.size[1] and is_string is False
+            and not decode and bbox is None):
+        jpeg = np.fromfile(imgfile, dtype=np.uint8)
+        if compute_global:
+            return jpeg, channel_stats(im), np.asarray(im.convert('RGB')) if mean_image else None
+        return jpeg
 
-    (wnew, hnew) = map(lambda x: int(round(scale_factor * x)), im.size)
-    if scale_factor != 1:
-        filt = PILImage.BICUBIC if scale_factor > 1 else PILImage.ANTIALIAS
-        im = im.resize((wnew, hnew), filt)
+    im = resize_img(im, target_size, squarecrop, draft, bbox, bbox_pad)
 
-    if squarecrop is True:
-        (cx, cy) = map(lambda x: (x - target_size) // 2, (wnew, hnew))
-        im = im.crop((cx, cy, cx+target_size, cy+target_size))
-
-    buf = StringIO()
-    im.save(buf, format='JPEG', subsampling=0, quality=95)
+    if decode:
+        out = np.asarray(im.convert('RGB'), dtype=np.uint8)
+    else:
+        buf = StringIO()
+        im.save(buf, format='JPEG', subsampling=0, quality=95)
+        out = buf.getvalue()
 
     if compute_global:
-        nim = np.array(im).mean(axis=0).mean(axis=0)
-        with r.get_lock():
-            r.value += nim[0]
-        with g.get_lock():
-            g.value += nim[1]
-        with b.get_lock():
-            b.value += nim[2]
-
-    return buf.getvalue()
+        return out, channel_stats(im), np.asarray(im.convert('RGB')) if mean_image else None
+    return out
+
+def read_columns(fname, dtype=np.float64, ncols=2):
+    """ Space separated table, parsed in one pass instead of line by line like np.loadtxt """
+    with open(fname, 'r') as f:
+        return np.array(f.read().split(), dtype=dtype).reshape((-1, ncols))
+
+def sample_per_class(labels, quota):
+    """
+    Sorted indices of a random sample of at most quota[l] rows of every label l.
+    """
+    order = np.random.permutation(len(labels))
+    order = order[np.argsort(labels[order], kind='mergesort')]
+    sorted_labels = labels[order]
+    # Rank of every row among the rows of its label
+    first = np.searchsorted(sorted_labels, sorted_labels)
+    rank = np.arange(len(order)) - first
+    return np.sort(order[rank < np.asarray(quota)[sorted_labels]])
+
+def water_fill(budget, capacity):
+    """
+    Splits an integer budget over children as evenly as their capacities allow.
+    """
+    capacity = np.asarray(capacity, dtype=np.int64)
+    budget = min(int(budget), capacity.sum())
+    c = np.sort(capacity)
+    n = len(c)
+    # Total handed out if the level were c[k]
+    filled = np.cumsum(c) - c + c * (n - np.arange(n))
+    k = np.searchsorted(filled, budget)
+    if k == n:
+        return capacity
+    level = (budget - (c[:k].sum())) // (n - k)
+    share = np.minimum(capacity, level)
+    # Hand the remainder out one by one to children with room left
+    room = np.flatnonzero(share < capacity)
+    share[room[:budget - share.sum()]] += 1
+    return share
+
+def taxonomy_quota(ctree, counts, budget):
+    """
+    Per label quota of a budget split evenly between the children of every internal node of
+    the taxonomy, top down, as far as the counts of the labels under each child allow.
+    """
+    nnodes = len(ctree.node_ids)
+    # Images under every node
+    path_len = np.diff(ctree.leaf_path_indptr)
+    capacity = np.bincount(ctree.leaf_path_indices, weights=np.repeat(counts, path_len),
+                           minlength=nnodes).astype(np.int64)
+    node_budget = np.zeros(nnodes, dtype=np.int64)
+    node_budget[0] = min(budget, capacity[0])
+    for n in np.flatnonzero(ctree.child_count > 0):
+        children = slice(ctree.child_offset[n], ctree.child_offset[n] + ctree.child_count[n])
+        node_budget[children] = water_fill(node_budget[n], capacity[children])
+    quota = np.zeros(len(counts), dtype=np.int64)
+    leaves = np.flatnonzero(ctree.node_labelidx >= 0)
+    quota[ctree.node_labelidx[leaves]] = node_budget[leaves]
+    return quota
+
+def cluster_order(groups, batch_size):
+    """
+    Random permutation of rows in which every run of batch_size rows comes from a single group,
+    apart from runs made of the groups' leftover rows. Runs are in random order.
+    """
+    order = np.random.permutation(len(groups))
+    order = order[np.argsort(groups[order], kind='mergesort')]
+    sorted_groups = groups[order]
+    first = np.searchsorted(sorted_groups, sorted_groups)
+    rank = np.arange(len(order)) - first
+    count = np.searchsorted(sorted_groups, sorted_groups, side='right') - first
+    # Full runs are keyed by the position of their first row, leftover rows are shuffled
+    # together and cut into runs of their own
+    full = rank < count - count % batch_size
+    pos = np.arange(len(order))
+    key = pos - rank % batch_size
+    leftover = np.flatnonzero(~full)
+    leftover = leftover[np.random.permutation(len(leftover))]
+    pos[leftover] = np.arange(len(leftover))
+    key[leftover] = -1 - pos[leftover] // batch_size
+    runs, run_idx = np.unique(key, return_inverse=True)
+    priority = np.random.permutation(len(runs))
+    if len(leftover) % batch_size:
+        # The short run goes last so every other run stays aligned to batch_size
+        priority[0] = len(runs)
+    return order[np.lexsort((pos, priority[run_idx]))]
+
+def subtree_groups(ctree, depth):
+    """
+    Id of the node at the given depth on the path of every label (the leaf itself if it is not
+    that deep, -1 for labels missing from the taxonomy).
+    """
+    path_len = np.diff(ctree.leaf_path_indptr)
+    node = ctree.leaf_path_indptr[:-1] + np.minimum(depth, path_len - 1)
+    return np.where(path_len > 0, ctree.leaf_path_indices[np.maximum(node, 0)], -1)
+
+def proc_img_bbox(proc_func, item):
+    imgfile, bbox = item
+    return proc_func(imgfile=imgfile, bbox=bbox)
 
 
 class BirdsBatchWriter(object):
+    """
+    Writes the NABirds images into macrobatches.
+
+    batch_format selects the macrobatch layout: 'neon' is the sequential format read by the
+    neon ImageLoader, 'indexed' adds an offset table so JPEGs can be memory mapped and sliced
+    individually, and 'raw' stores pre-decoded uint8 (N, H, W, 3) images (requires squarecrop).
+    Use IndexedMacrobatch to read the last two.
+
+    Images are streamed through the worker pool with at most queue_depth chunks of chunk_size
+    images in flight, so workers keep decoding while earlier records are written and memory
+    does not grow with macro_size.
+
+    Builds are incremental: manifest.pkl records the source files, labels, record offsets and
+    content hash of every batch. Batches whose sources and parameters are unchanged and whose
+    files are intact are skipped, and records of unchanged source images are copied from the
+    previous batches instead of being re-encoded. New batches are written next to the old ones
+    and only swapped in once a whole split is done, so an interrupted run resumes where it
+    stopped.
+
+    The train set's exact per channel mean and std are merged from per image statistics
+    returned by the workers. With mean_image the (H, W, 3) mean image is also accumulated in
+    totals, which needs squarecrop.
+
+    draft decodes JPEGs directly at a reduced DCT scale, which makes resizing several times
+    cheaper for large sources. Before writing, draft_check train images are compared with the
+    full decode and the build stops if their mean PSNR is below DRAFT_MIN_PSNR. bbox_crop
+    crops every image to a square around its bounding_boxes.txt box, grown by bbox_pad.
+
+    The build can be split over num_shards hosts sharing out_dir. Shard shard_index writes a
+    contiguous range of the macrobatches of every split, keeps its own manifest and saves the
+    merged statistics of its train batches; merge_shards then combines the shards into
+    dataset_cache.pkl. The file lists are shuffled with a fixed seed, so every shard agrees on
+    the contents of every batch.
+
+    class_samples_max caps the images of every class in each split. With subset_size, train
+    gets a subset of about that many images (and test and validation the same fraction of
+    theirs) which is balanced top down over the taxonomy in taxonomy_file, so every internal
+    node splits its share evenly between its children.
+
+    With cluster_batch_size the train list is ordered in runs of that many images from the same
+    subtree at cluster_depth of the taxonomy, so each minibatch of a loader which does not
+    shuffle reaches fewer node classifiers. Runs only line up with minibatches if
+    cluster_batch_size is the training batch size and divides macro_size.
+    """
 
     def __init__(self, out_dir, dataset_dir, target_size=256, squarecrop=True,
-                 class_samples_max=None, file_pattern='*.jpg', macro_size=3072):
+                 class_samples_max=None, file_pattern='*.jpg', macro_size=3072,
+                 batch_format='neon', queue_depth=16, chunk_size=16, mean_image=False,
+                 draft=False, draft_check=16, bbox_crop=False, bbox_pad=0.2,
+                 num_workers=None, shard_index=0, num_shards=1, subset_size=None,
+                 taxonomy_file='taxonomy_dict.p', taxonomy_root='Aves',
+                 cluster_batch_size=None, cluster_depth=1):
         np.random.seed(0)
         self.out_dir = os.path.expanduser(out_dir)
         self.dataset_dir = os.path.expanduser(dataset_dir)
         self.macro_size = macro_size
-        self.num_workers = 8
+        self.num_workers = num_workers or cpu_count()
+        if not 0 <= shard_index < num_shards:
+            raise ValueError("shard_index must be in [0, %d)" % num_shards)
+        self.shard_index = shard_index
+        self.num_shards = num_shards
         self.target_size = target_size
         self.squarecrop = squarecrop
         self.file_pattern = file_pattern
         self.class_samples_max = class_samples_max
+        self.subset_size = subset_size
+        self.taxonomy_file = taxonomy_file
+        self.taxonomy_root = taxonomy_root
+        self.cluster_batch_size = cluster_batch_size
+        self.cluster_depth = cluster_depth
+        self.ctree = None
+        if batch_format not in ('neon', 'indexed', 'raw'):
+            raise NotImplementedError(batch_format + " batch format has not been implemented")
+        if batch_format == 'raw' and not squarecrop:
+            raise ValueError("raw batches need fixed size images, use squarecrop")
+        self.batch_format = batch_format
+        if mean_image and not squarecrop:
+            raise ValueError("a mean image needs fixed size images, use squarecrop")
+        self.mean_image = mean_image
+        self.queue_depth = queue_depth
+        self.chunk_size = chunk_size
+        self.draft = draft
+        self.draft_check = draft_check
+        self.bbox_crop = bbox_crop
+        self.bbox_pad = bbox_pad
+        self.bboxes = {}
         self.train_file = os.path.join(self.out_dir, 'train_file.csv.gz')
         self.val_file = os.path.join(self.out_dir, 'val_file.csv.gz')
         self.test_file = os.path.join(self.out_dir, 'test_file.csv.gz')
         self.meta_file = os.path.join(self.out_dir, 'dataset_cache.pkl')
+        shard_suffix = '' if num_shards == 1 else '_shard%d_of_%d' % (shard_index, num_shards)
+        self.manifest_file = os.path.join(self.out_dir, 'manifest%s.pkl' % shard_suffix)
+        self.manifest = {'version': MANIFEST_VERSION, 'batches': {}, 'pending': {}}
         self.totals = np.zeros((target_size, target_size, 3))
         self.global_mean = np.array([0, 0, 0]).reshape((3, 1))
+        self.global_std = np.array([0, 0, 0]).reshape((3, 1))
         self.batch_prefix = 'data_batch_'
 
     def write_csv_files(self):
         # image_idx : split
-        split_file = np.loadtxt(os.path.join(self.dataset_dir, 'train_test_val_split.txt'), delimiter=' ')
+        split_file = read_columns(os.path.join(self.dataset_dir, 'train_test_val_split.txt'))
         # image_idx : file_name
-        images_key = np.loadtxt(os.path.join(self.dataset_dir, 'images.txt'), delimiter=' ', dtype='str')
+        images_key = read_columns(os.path.join(self.dataset_dir, 'images.txt'), dtype='str')
         # image_idx : class_idx
-        image_class_labels = np.loadtxt(os.path.join(self.dataset_dir, 'image_class_labels.txt'), delimiter=' ') - 1
+        image_class_labels = read_columns(os.path.join(self.dataset_dir, 'image_class_labels.txt')) - 1
         # image_idx : class_name
         self.label_names = [x.strip()[x.index(' ')+1:] for x in open(os.path.join(self.dataset_dir, 'classes.txt'), 'r').readlines()]
 
         self.nclass = len(self.label_names)
         self.label_dict = dict(zip(self.label_names, range(self.nclass)))
+        if self.bbox_crop:
+            self.load_bboxes(images_key)
 
-        # Get the labels as the subdirs
-        tlines = []
-        tslines = []
-        vlines = []
-        splits = {0:tlines, 1:tslines, 2:vlines}
-        for i in xrange(split_file.shape[0]):
-            if self.class_samples_max and i > self.class_samples_max:
-                break
-            full_filename = os.path.join(os.path.join(self.dataset_dir, 'images'), images_key[i, 1])
-            splits[split_file[i, 1]].append((full_filename, image_class_labels[i, 1]))
+        # Split, label and file name of every image are joined on their row
+        fnames = np.char.add(os.path.join(self.dataset_dir, 'images') + os.sep, images_key[:, 1])
+        lbls = image_class_labels[:, 1].astype(np.int32)
+        tidx, tsidx, vidx = [self.sample_split(lbls, np.flatnonzero(split_file[:, 1] == k),
+                                               split_file[:, 1] == 0)
+                             for k in (0, 1, 2)]
 
-        np.random.shuffle(tlines)
+        np.random.shuffle(tidx)
+        if self.cluster_batch_size:
+            groups = subtree_groups(self.taxonomy(), self.cluster_depth)
+            tidx = tidx[cluster_order(groups[lbls[tidx]], self.cluster_batch_size)]
 
         if not os.path.exists(self.out_dir):
             os.makedirs(self.out_dir)
 
-        for ff, ll in zip([self.train_file, self.test_file, self.val_file], [tlines, tslines, vlines]):
-            with gzip.open(ff, 'wb') as f:
-                f.write('filename,l_id\n')
-                for tup in ll:
-                    f.write('{},{}\n'.format(*tup))
+        for ff, idx in zip([self.train_file, self.test_file, self.val_file], [tidx, tsidx, vidx]):
+            self.write_file_list(ff, fnames[idx], lbls[idx])
 
-        self.train_nrec = len(tlines)
+        self.train_nrec = len(tidx)
         self.ntrain = -(-self.train_nrec // self.macro_size)
         self.train_start = 0
 
-        self.test_nrec = len(tslines)
+        self.test_nrec = len(tsidx)
         self.ntest = -(-self.test_nrec // self.macro_size)
         self.test_start = self.train_start + self.ntrain + 1
 
-        self.val_nrec = len(vlines)
+        self.val_nrec = len(vidx)
         self.nval = -(-self.val_nrec // self.macro_size)
         self.val_start = self.test_start + self.ntest + 1
 
+    def taxonomy(self):
+        if self.ctree is None:
+            self.ctree = ClassTaxonomy(self.taxonomy_root, self.taxonomy_file, self.dataset_dir)
+        return self.ctree
+
+    def sample_split(self, lbls, idx, train_mask):
+        if not self.class_samples_max and not self.subset_size:
+            return idx
+        counts = np.bincount(lbls[idx], minlength=self.nclass)
+        quota = counts
+        if self.class_samples_max:
+            quota = np.minimum(quota, self.class_samples_max)
+        if self.subset_size:
+            budget = int(round(self.subset_size * len(idx) / float(max(train_mask.sum(), 1))))
+            quota = taxonomy_quota(self.taxonomy(), quota, budget)
+        return idx[sample_per_class(lbls[idx], quota)]
+
+    def index_file(self, csv_file):
+        return csv_file[:-len('.csv.gz')] + '.npy'
+
+    def write_file_list(self, csv_file, fnames, lbls):
+        """
+        Writes a split as a gzipped csv and as a binary index which parse_file_list memory maps.
+        """
+        index = np.zeros(len(fnames), dtype=[('fname', fnames.dtype), ('l_id', np.int32)])
+        index['fname'] = fnames
+        index['l_id'] = lbls
+        # Shards write identical lists, the rename keeps readers from seeing a partial file
+        for fname, write in [(csv_file, self._write_csv), (self.index_file(csv_file), np.save)]:
+            tmp_file = '%s.%d.tmp' % (fname, self.shard_index)
+            with open(tmp_file, 'wb') as f:
+                write(f, index)
+            os.rename(tmp_file, fname)
+
+    def _write_csv(self, f, index):
+        lines = np.char.add(np.char.add(index['fname'], ','), index['l_id'].astype(str))
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.write('filename,l_id\n')
+            if len(lines) > 0:
+                gz.write('\n'.join(lines) + '\n')
+
+    def load_bboxes(self, images_key):
+        # image_idx : x y width height, keyed by the full file name like the csv files
+        boxes = {}
+        for line in open(os.path.join(self.dataset_dir, 'bounding_boxes.txt'), 'r'):
+            fields = line.split()
+            if len(fields) == 5:
+                boxes[fields[0]] = tuple(float(x) for x in fields[1:])
+        image_dir = os.path.join(self.dataset_dir, 'images')
+        self.bboxes = {os.path.join(image_dir, fname): boxes[img_id]
+                       for img_id, fname in images_key if img_id in boxes}
+
     def parse_file_list(self, infile):
-        lines = np.loadtxt(infile, delimiter=',', skiprows=1, dtype={'names': ('fname', 'l_id'),
-                                                                     'formats': (object, 'i4')})
-        imfiles = [l[0] for l in lines]
-        labels = {'l_id': [l[1] for l in lines]}
-        self.nclass = {'l_id': (max(labels['l_id']) + 1)}
+        index_file = self.index_file(infile)
+        if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(infile):
+            lines = np.load(index_file, mmap_mode='r')
+        else:
+            lines = np.loadtxt(infile, delimiter=',', skiprows=1, ndmin=1,
+                               dtype={'names': ('fname', 'l_id'), 'formats': (object, 'i4')})
+        imfiles = lines['fname']
+        labels = {'l_id': lines['l_id']}
+        self.nclass = {'l_id': (labels['l_id'].max() + 1)}
         return imfiles, labels
 
+    def shard_batches(self, nbatches):
+        # Contiguous range of batch indices of a split written by this shard
+        return range(nbatches * self.shard_index // self.num_shards,
+                     nbatches * (self.shard_index + 1) // self.num_shards)
+
+    def shard_stats_file(self, shard_index):
+        return os.path.join(self.out_dir, 'stats_shard%d_of_%d.pkl' % (shard_index,
+                                                                       self.num_shards))
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_file):
+            manifest = load_obj(self.manifest_file)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.manifest = manifest
+
+    def save_manifest(self):
+        tmp_file = self.manifest_file + '.tmp'
+        save_obj(self.manifest, tmp_file)
+        os.rename(tmp_file, self.manifest_file)
+
+    def source_signature(self, imfile):
+        # Images are re-encoded when their path, size or mtime change
+        if not isinstance(imfile, basestring):
+            return None
+        st = os.stat(imfile)
+        return (imfile, st.st_size, int(st.st_mtime), self.bboxes.get(imfile))
+
+    def record_params(self):
+        # Parameters which change the content of an encoded record
+        return (self.target_size, self.squarecrop, self.batch_format == 'raw', self.draft,
+                self.bbox_pad if self.bbox_crop else None)
+
+    def file_sha1(self, fname):
+        h = sha1()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def batch_is_valid(self, entry):
+        # Each file is hashed at most once per split
+        if entry['file'] not in self._verified:
+            self._verified[entry['file']] = (
+                os.path.exists(entry['file']) and os.path.getsize(entry['file']) == entry['size']
+                and self.file_sha1(entry['file']) == entry['sha1'])
+        return self._verified[entry['file']]
+
+    def batch_is_current(self, entry, sources, labels):
+        if entry is None or None in sources:
+            return False
+        if (entry['params'], entry['format']) != (self.record_params(), self.batch_format):
+            return False
+        if entry['sources'] != sources or entry['labels'] != labels:
+            return False
+        if self.mean_image and entry['stats'] is not None and entry['totals'] is None:
+            return False
+        return self.batch_is_valid(entry)
+
+    def record_pixels(self, record):
+        if self.batch_format == 'raw':
+            return record
+        return np.asarray(PILImage.open(StringIO(record)).convert('RGB'))
+
+    def read_record(self, handles, fname, offset, length):
+        if fname not in handles:
+            handles[fname] = open(fname, 'rb')
+        handles[fname].seek(offset)
+        record = handles[fname].read(length)
+        if self.batch_format == 'raw':
+            return np.frombuffer(record, dtype=np.uint8).reshape(
+                (self.target_size, self.target_size, 3))
+        return record
+
     def write_batches(self, name, offset, labels, imfiles, compute_global=False):
         pool = Pool(processes=self.num_workers)
         npts = -(-len(imfiles) // self.macro_size)
         starts = [i * self.macro_size for i in range(npts)]
         is_tar = isinstance(imfiles[0], tarfile.ExFileObject)
-        proc_img_func = functools.partial(proc_img, self.target_size, self.squarecrop, is_tar, compute_global)
-        imfiles = [imfiles[s:s + self.macro_size] for s in starts]
-        labels = [{k: v[s:s + self.macro_size] for k, v in labels.iteritems()} for s in starts]
+        proc_img_func = functools.partial(proc_img, self.target_size, self.squarecrop, is_tar,
+                                          compute_global, self.batch_format == 'raw',
+                                          self.mean_image, self.draft, self.bbox_pad)
+        if self.bbox_crop:
+            proc_img_func = functools.partial(proc_img_bbox, proc_img_func)
+        write_func = {'neon': self.write_binary, 'indexed': self.write_indexed,
+                      'raw': self.write_raw}[self.batch_format]
+        labels = [{k: list(v[s:s + self.macro_size]) for k, v in labels.iteritems()} for s in starts]
+        sources = [self.source_signature(f) for f in imfiles]
+
+        # Records of the current batches which can be copied instead of re-encoded
+        self._verified = {}
+        reusable = {}
+        for entry in self.manifest['batches'].values():
+            if entry['params'] == self.record_params() and self.batch_is_valid(entry):
+                for j, src in enumerate(entry['sources']):
+                    stats = entry['stats'][j] if entry['stats'] is not None else None
+                    if src is not None and (stats is not None or not compute_global):
+                        reusable[src] = (entry['file'],) + tuple(entry['records'][j]) + (stats,)
+
+        todo, encode = [], []
+        for i in self.shard_batches(npts):
+            s = starts[i]
+            bname = '%s%d' % (self.batch_prefix, offset + i)
+            srcs = sources[s:s + self.macro_size]
+            if self.batch_is_current(self.manifest['batches'].get(bname), srcs, labels[i]):
+                # Drop any stale leftover of an interrupted rebuild of this batch
+                pending = self.manifest['pending'].pop(bname, None)
+                if pending is not None and os.path.exists(pending['file']):
+                    os.remove(pending['file'])
+                print("Skipping batch %d, already written" % (i))
+                continue
+            if self.batch_is_current(self.manifest['pending'].get(bname), srcs, labels[i]):
+                print("Skipping batch %d, resumed from an interrupted run" % (i))
+                continue
+            todo.append((i, bname, srcs))
+            encode.extend((f, self.bboxes.get(f)) if self.bbox_crop else f
+                          for f, src in zip(imfiles[s:s + self.macro_size], srcs)
+                          if src not in reusable)
 
         print("Writing %s batches..." % (name))
-        for i, jpeg_file_batch in enumerate(imfiles):
-            if is_tar:
-                jpeg_file_batch = [j.read() for j in jpeg_file_batch]
-            jpeg_strings = pool.map(proc_img_func, jpeg_file_batch)
-            bfile = os.path.join(self.out_dir, '%s%d' % (self.batch_prefix, offset + i))
-            self.write_binary(jpeg_strings, labels[i], bfile)
+        encoded = self.imap_bounded(pool, proc_img_func, encode, is_tar)
+        handles = {}
+        for i, bname, srcs in todo:
+            stats = []
+            totals = np.zeros(self.totals.shape) if compute_global and self.mean_image else None
+
+            def records():
+                for src in srcs:
+                    pixels = None
+                    if src in reusable:
+                        fname, roff, rlen, stat = reusable[src]
+                        out = self.read_record(handles, fname, roff, rlen)
+                        if totals is not None:
+                            pixels = self.record_pixels(out)
+                    else:
+                        out = next(encoded)
+                        out, stat, pixels = out if compute_global else (out, None, None)
+                    stats.append(stat)
+                    if totals is not None:
+                        totals[:] += pixels
+                    yield out
+
+            bfile = os.path.join(self.out_dir, bname)
+            tmp_file = bfile + '.partial'
+            record_offsets = write_func(records(), labels[i], tmp_file)
+            self.manifest['pending'][bname] = {
+                'file': tmp_file, 'params': self.record_params(), 'format': self.batch_format,
+                'sources': srcs, 'labels': labels[i], 'records': record_offsets,
+                'stats': stats if compute_global else None, 'totals': totals,
+                'size': os.path.getsize(tmp_file), 'sha1': self.file_sha1(tmp_file)}
+            self.save_manifest()
             print("Writing batch %d" % (i))
         pool.close()
+        pool.join()
+        for h in handles.values():
+            h.close()
+        self.commit_batches()
+
+    def commit_batches(self):
+        # Swap in every finished batch once nothing reads the records of the old ones
+        for bname, entry in self.manifest['pending'].items():
+            bfile = os.path.join(self.out_dir, bname)
+            if entry['file'] != bfile:
+                os.rename(entry['file'], bfile)
+                entry['file'] = bfile
+            self.manifest['batches'][bname] = entry
+        self.manifest['pending'] = {}
+        self.save_manifest()
+
+    def imap_bounded(self, pool, func, items, is_tar=False):
+        """
+        Ordered pool.imap which keeps at most queue_depth chunks in flight. Tar members are
+        only read when their chunk is dispatched.
+        """
+        items = iter(items)
+        pending = deque()
+        while True:
+            while len(pending) < self.queue_depth:
+                chunk = list(itertools.islice(items, self.chunk_size))
+                if len(chunk) == 0:
+                    break
+                if is_tar:
+                    chunk = [j.read() for j in chunk]
+                pending.append(pool.map_async(func, chunk))
+            if len(pending) == 0:
+                return
+            for result in pending.popleft().get():
+                yield result
+
+    def _sync(self, f):
+        # Make sure a batch is on disk before it is reported as written
+        f.flush()
+        os.fsync(f.fileno())
 
     def write_binary(self, jpegs, labels, ofname):
-        num_imgs = len(jpegs)
+        """
+        jpegs may be any iterable, records are written as they arrive.
+        Returns the (offset, length) of every JPEG in the file.
+        """
+        num_imgs = len(labels['l_id'])
+        record_offsets = []
         keylist = ['l_id']
         with open(ofname, 'wb') as f:
             f.write(struct.pack('I', num_imgs))
             f.write(struct.pack('I', len(keylist)))
 
             for key in keylist:
-                ksz = len(key)
-                f.write(struct.pack('L' + 'B' * ksz, ksz, *bytearray(key)))
-                f.write(struct.pack('I' * num_imgs, *labels[key]))
-
-            for i in range(num_imgs):
-                jsz = len(jpegs[i])
-                bin = struct.pack('I' + 'B' * jsz, jsz, *bytearray(jpegs[i]))
-                f.write(bin)
+                f.write(struct.pack('L', len(key)) + key)
+                f.write(np.asarray(labels[key], dtype=np.uint32).tostring())
+
+            # Each record is its native uint32 length followed by the raw JPEG bytes
+            pos = f.tell()
+            for jpeg in jpegs:
+                jpeg = jpeg.tostring() if isinstance(jpeg, np.ndarray) else jpeg
+                f.writelines([struct.pack('I', len(jpeg)), jpeg])
+                record_offsets.append((pos + 4, len(jpeg)))
+                pos += 4 + len(jpeg)
+            self._sync(f)
+        return record_offsets
+
+    def _write_indexed_header(self, f, magic, labels, shape=(0, 0, 0)):
+        lbls = np.asarray(labels['l_id'], dtype=np.uint32)
+        f.write(INDEXED_HEADER.pack(magic, INDEXED_VERSION, len(lbls), *shape))
+        f.write(lbls.tostring())
+        f.write(b'\0' * (_align(f.tell()) - f.tell()))
+
+    def write_indexed(self, jpegs, labels, ofname):
+        offsets = np.zeros(len(labels['l_id']) + 1, dtype=np.uint64)
+        with open(ofname, 'wb') as f:
+            self._write_indexed_header(f, JPEG_MAGIC, labels)
+            # Reserve the offset table and fill it in once every record is written
+            table_start = f.tell()
+            f.write(offsets.tostring())
+            for i, jpeg in enumerate(jpegs):
+                jpeg = jpeg.tostring() if isinstance(jpeg, np.ndarray) else jpeg
+                f.write(jpeg)
+                offsets[i + 1] = offsets[i] + len(jpeg)
+            f.seek(table_start)
+            f.write(offsets.tostring())
+            self._sync(f)
+        data_start = table_start + offsets.nbytes
+        return [(data_start + int(o), int(l)) for o, l in zip(offsets[:-1], np.diff(offsets))]
+
+    def write_raw(self, imgs, labels, ofname):
+        imgs = iter(imgs)
+        first = next(imgs)
+        with open(ofname, 'wb') as f:
+            self._write_indexed_header(f, RAW_MAGIC, labels, first.shape)
+            pos = f.tell()
+            for img in itertools.chain([first], imgs):
+                assert img.shape == first.shape, "raw batches need fixed size images"
+                f.write(np.ascontiguousarray(img).tostring())
+            self._sync(f)
+        return [(pos + i * first.nbytes, first.nbytes) for i in range(len(labels['l_id']))]
+
+    def check_draft(self, imfiles):
+        # Compare the draft path with a full decode on a sample of images
+        if not self.draft or self.draft_check == 0 or not isinstance(imfiles[0], basestring):
+            return
+        scores = []
+        for imfile in imfiles[:self.draft_check]:
+            full, fast = [resize_img(PILImage.open(imfile), self.target_size, self.squarecrop,
+                                     draft, self.bboxes.get(imfile), self.bbox_pad)
+                          for draft in (False, True)]
+            scores.append(min(psnr(full.convert('RGB'), fast.convert('RGB')), 99.0))
+        print("Draft decoding PSNR %.1f dB (min %.1f dB) over %d images" % (
+            np.mean(scores), np.min(scores), len(scores)))
+        if np.mean(scores) < DRAFT_MIN_PSNR:
+            raise ValueError("draft decoding is below %.1f dB PSNR, rerun without --draft" %
+                             DRAFT_MIN_PSNR)
 
     def save_meta(self):
         save_obj({'ntrain': self.ntrain,
@@ -179,14 +768,22 @@ class BirdsBatchWriter(object):
                   'macro_size': self.macro_size,
                   'batch_prefix': self.batch_prefix,
                   'global_mean': self.global_mean,
+                  'global_std': self.global_std,
                   'label_dict': self.label_dict,
                   'label_names': self.label_names,
                   'val_nrec': self.val_nrec,
                   'train_nrec': self.train_nrec,
                   'img_size': self.target_size,
+                  'batch_format': self.batch_format,
                   'nclass': self.nclass}, self.meta_file)
+        if self.mean_image:
+            save_obj(self.totals / self.train_nrec, os.path.join(self.out_dir, 'mean_image.pkl'))
 
     def run(self):
+        if self.num_shards > 1 and os.path.exists(self.shard_stats_file(self.shard_index)):
+            # Keep a merge from picking up the statistics of an earlier build
+            os.remove(self.shard_stats_file(self.shard_index))
+        self.load_manifest()
         self.write_csv_files()
         namelist = ['train', 'test', 'validation']
         filelist = [self.train_file, self.test_file, self.val_file]
@@ -196,13 +793,53 @@ class BirdsBatchWriter(object):
             if fname is not None and os.path.exists(fname):
                 imgs, labels = self.parse_file_list(fname)
                 if sname == 'train':
+                    self.check_draft(imgs)
                     self.write_batches(sname, start, labels, imgs, compute_global=True)
                 else:
                     self.write_batches(sname, start, labels, imgs)
             else:
                 print("Skipping %s, file missing" % (sname))
-        self.global_mean = np.array([r.value, g.value, b.value]).reshape((3, 1)) / self.train_nrec
+        # Statistics of every train record, including the ones which were not re-encoded
+        train_stats = []
+        totals = np.zeros(self.totals.shape) if self.mean_image else None
+        for i in self.shard_batches(self.ntrain):
+            entry = self.manifest['batches']['%s%d' % (self.batch_prefix, self.train_start + i)]
+            train_stats.extend(entry['stats'])
+            if self.mean_image:
+                totals += entry['totals']
+        shard = {'shard_index': self.shard_index, 'num_shards': self.num_shards,
+                 'stats': merge_stats(train_stats) if len(train_stats) > 0 else None,
+                 'totals': totals}
+        if self.num_shards == 1:
+            self.finish([shard])
+        else:
+            save_obj(shard, self.shard_stats_file(self.shard_index))
+            print("Shard %d of %d done, run with --merge_shards once every shard is done" % (
+                self.shard_index, self.num_shards))
+
+    def merge_shards(self):
+        """
+        Combines the train statistics saved by every shard and writes dataset_cache.pkl.
+        """
+        self.write_csv_files()
+        shards = []
+        for k in range(self.num_shards):
+            if not os.path.exists(self.shard_stats_file(k)):
+                raise IOError("shard %d of %d has not finished" % (k, self.num_shards))
+            shards.append(load_obj(self.shard_stats_file(k)))
+        self.finish(shards)
+
+    def finish(self, shards):
+        self.totals[:] = 0
+        for shard in shards:
+            if shard['totals'] is not None:
+                self.totals += shard['totals']
+        count, mean, m2 = merge_stats([shard['stats'] for shard in shards
+                                       if shard['stats'] is not None])
+        self.global_mean = mean.reshape((3, 1))
+        self.global_std = np.sqrt(m2 / count).reshape((3, 1))
         print "Global mean", self.global_mean
+        print "Global std", self.global_std
         self.save_meta()
 
 if __name__ == "__main__":
@@ -211,7 +848,35 @@ if __name__ == "__main__":
     parser.add_argument('--target_size', type=int, default=256,
                         help='Size in pixels to scale images (Must be 256 for i1k dataset)')
     parser.add_argument('--macro_size', type=int, default=2000, help='Images per processed batch')
-    parser.add_argument('--class_samples_max', help='Only process smaller amount of images', type=int, default=None)
+    parser.add_argument('--batch_format', default='neon', choices=['neon', 'indexed', 'raw'],
+                        help='Macrobatch layout, indexed and raw can be memory mapped')
+    parser.add_argument('--queue_depth', type=int, default=16,
+                        help='Chunks of images in flight in the worker pool')
+    parser.add_argument('--mean_image', type=bool, default=False,
+                        help='Also save the per pixel mean image of the train set')
+    parser.add_argument('--draft', type=bool, default=False,
+                        help='Decode JPEGs at a reduced scale before resizing')
+    parser.add_argument('--bbox_crop', type=bool, default=False,
+                        help='Crop images to a square around their bounding box')
+    parser.add_argument('--bbox_pad', type=float, default=0.2,
+                        help='Context kept around the bounding box, as a fraction of its size')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='Processes resizing images, defaults to the number of cores')
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help='Index of the part of the batches written by this host')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='Number of hosts the batches are split over')
+    parser.add_argument('--merge_shards', type=bool, default=False,
+                        help='Merge the statistics of finished shards into dataset_cache.pkl')
+    parser.add_argument('--class_samples_max', help='Only process this many images of every class', type=int, default=None)
+    parser.add_argument('--subset_size', type=int, default=None,
+                        help='Only process a subset of about this many train images balanced over the taxonomy')
+    parser.add_argument('--taxonomy_file', default='taxonomy_dict.p',
+                        help='Taxonomy adjacency pickle used to balance the subset')
+    parser.add_argument('--cluster_batch_size', type=int, default=None,
+                        help='Order train images in runs of this many from the same subtree')
+    parser.add_argument('--cluster_depth', type=int, default=1,
+                        help='Taxonomy depth of the subtrees train runs are drawn from')
     args = parser.parse_args()
 
     logger = logging.getLogger(__name__)
@@ -220,6 +885,15 @@ if __name__ == "__main__":
     # out_dir defaults to ~/nervana/data
     bw = BirdsBatchWriter(out_dir=args.data_dir, dataset_dir=args.dataset_dir,
                      target_size=args.target_size, macro_size=args.macro_size,
-                     class_samples_max=args.class_samples_max)
-
-    bw.run()
+                     class_samples_max=args.class_samples_max, batch_format=args.batch_format,
+                     queue_depth=args.queue_depth, mean_image=args.mean_image,
+                     draft=args.draft, bbox_crop=args.bbox_crop, bbox_pad=args.bbox_pad,
+                     num_workers=args.num_workers, shard_index=args.shard_index,
+                     num_shards=args.num_shards, subset_size=args.subset_size,
+                     taxonomy_file=args.taxonomy_file, cluster_batch_size=args.cluster_batch_size,
+                     cluster_depth=args.cluster_depth)
+
+    if args.merge_shards:
+        bw.merge_shards()
+    else:
+        bw.run()
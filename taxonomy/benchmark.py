@@ -0,0 +1,201 @@
+"""
+Benchmarks the taxonomic heads against the flat softmax head on the CPU backend, using
+synthetic features and the taxonomy in taxonomy_dict.p. Every configuration runs in a fresh
+process so its peak memory is its own. Results are written as JSON.
+
+Example command:
+python benchmark.py --batch_sizes 32 64 128 --collapse 1 0 --output benchmark.json
+"""
+import argparse
+from hashlib import sha1
+import json
+from multiprocessing import Pool
+import os
+import pickle
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from neon.backends import gen_backend
+from neon.layers import Dropout, GeneralizedCost
+from neon.models import Model
+from neon.optimizers import GradientDescentMomentum
+from neon.transforms import CrossEntropyMulti
+from neon.util.persist import save_obj
+
+from class_taxonomy import ClassTaxonomy
+from feature_cache import feature_files, FeatureLoader
+from model_branch import TaxonomicBranchModel
+from model_descriptions import create_alexnet_layers, create_branched, create_fused
+
+HEADS = ['flat', 'branch', 'grouped', 'fused']
+
+
+def write_classes(adj_file, out_dir):
+    """ classes.txt listing the leaves of the taxonomy, in place of the dataset's """
+    adj = pickle.load(open(adj_file, 'rb'))
+    leaves = sorted(set(c for v in adj.values() for c in v) - set(adj))
+    with open(os.path.join(out_dir, 'classes.txt'), 'w') as f:
+        for i, name in enumerate(leaves):
+            f.write('%d %s\n' % (i, name))
+    return len(leaves)
+
+
+def write_features(prefix, ndata, nfeat, nclass):
+    """ Feature store of random features and labels, read with FeatureLoader """
+    feat_file, label_file, meta_file = feature_files(prefix)
+    rng = np.random.RandomState(0)
+    np.save(feat_file, rng.randn(ndata, nfeat).astype(np.float32))
+    np.save(label_file, rng.randint(nclass, size=ndata).astype(np.int32))
+    save_obj({'ndata': ndata, 'nclass': nclass, 'shape': nfeat}, meta_file)
+
+
+class MinibatchTimer(object):
+    """ Stands in for the Callbacks container and times every minibatch after the first epoch """
+
+    def __init__(self):
+        self.times = []
+
+    def on_train_begin(self, epochs):
+        pass
+
+    def on_train_end(self):
+        pass
+
+    def on_epoch_begin(self, epoch):
+        self.epoch = epoch
+
+    def on_epoch_end(self, epoch):
+        pass
+
+    def on_minibatch_begin(self, epoch, minibatch):
+        self.start = time.time()
+
+    def on_minibatch_end(self, epoch, minibatch):
+        if epoch > 0:
+            self.times.append(time.time() - self.start)
+
+
+def feature_layers(nclass):
+    """ Input layer over the synthetic features, then the flat softmax head of AlexNet """
+    return [Dropout(keep=1.0), create_alexnet_layers(nclass)[-1]]
+
+
+def build_model(head, ctree, loader):
+    if head == 'flat':
+        return Model(layers=feature_layers(loader.nclass))
+    if head == 'fused':
+        return TaxonomicBranchModel(layers=create_fused(feature_layers, ctree, loader))
+    return TaxonomicBranchModel(layers=create_branched(feature_layers, ctree, loader,
+                                                       grouped=head == 'grouped'))
+
+
+def timed(times, batch_size):
+    total = np.sum(times)
+    return {'minibatches_per_sec': len(times) / total,
+            'latency_per_sample_ms': 1e3 * total / (len(times) * batch_size)}
+
+
+def run_config(cfg):
+    """ Trains and evaluates one head at one batch size and taxonomy setting """
+    gen_backend(backend='cpu', batch_size=cfg['batch_size'], rng_seed=0)
+    np.random.seed(0)
+    ctree = None
+    if cfg['head'] != 'flat':
+        ctree = ClassTaxonomy('Aves', cfg['adj_file'], cfg['work_dir'],
+                              collapse=bool(cfg['collapse']))
+    loader = FeatureLoader(cfg['store'])
+    model = build_model(cfg['head'], ctree, loader)
+
+    results = []
+    timer = MinibatchTimer()
+    model.fit(loader, cost=GeneralizedCost(costfunc=CrossEntropyMulti()),
+              optimizer=GradientDescentMomentum(0.01, 0.9), num_epochs=cfg['epochs'],
+              callbacks=timer)
+    results.append(dict(mode='train', **timed(timer.times, cfg['batch_size'])))
+
+    passes = {'inference': lambda x, t: model.fprop(x, inference=True)}
+    if cfg['head'] != 'flat':
+        def root_preds(x, t):
+            for l in model.layers.layers[:-1]:
+                x = l.fprop(x, inference=True)
+            return model.layers.layers[-1].get_root_preds(x, t)
+        passes['get_root_preds'] = root_preds
+    for mode, func in sorted(passes.items()):
+        times = []
+        for epoch in range(cfg['epochs']):
+            for x, t in loader:
+                start = time.time()
+                func(x, t)
+                if epoch > 0:
+                    times.append(time.time() - start)
+        results.append(dict(mode=mode, **timed(times, cfg['batch_size'])))
+
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    config = {k: cfg[k] for k in ('head', 'batch_size', 'collapse')}
+    return [dict(peak_rss_mb=peak_rss_mb, **dict(config, **r)) for r in results]
+
+
+def run(adj_file, batch_sizes, collapse, heads, nfeat, nbatches, epochs):
+    work_dir = tempfile.mkdtemp()
+    try:
+        nclass = write_classes(adj_file, work_dir)
+        store = os.path.join(work_dir, 'features')
+        write_features(store, nbatches * max(batch_sizes), nfeat, nclass)
+        configs = []
+        for head in heads:
+            # The flat head does not depend on the taxonomy
+            for c in ([None] if head == 'flat' else collapse):
+                for bsz in batch_sizes:
+                    configs.append({'head': head, 'batch_size': bsz, 'collapse': c,
+                                    'adj_file': os.path.abspath(adj_file), 'work_dir': work_dir,
+                                    'store': store, 'epochs': epochs})
+        results = []
+        for cfg in configs:
+            print("Benchmarking %(head)s head, batch size %(batch_size)d, collapse %(collapse)s"
+                  % cfg)
+            pool = Pool(processes=1)
+            results.extend(pool.apply(run_config, (cfg,)))
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(work_dir)
+
+    with open(adj_file, 'rb') as f:
+        taxonomy_sha1 = sha1(f.read()).hexdigest()
+    meta = {'platform': platform.platform(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'taxonomy_sha1': taxonomy_sha1, 'nclass': nclass,
+            'nfeat': nfeat, 'nbatches': nbatches, 'measured_epochs': epochs - 1}
+    return {'meta': meta, 'results': results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--adj_file', default='taxonomy_dict.p', help='Taxonomy adjacency pickle')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 64, 128])
+    parser.add_argument('--collapse', type=int, nargs='+', default=[1, 0],
+                        help='Tree collapse settings to sweep, 1 collapses single child nodes')
+    parser.add_argument('--heads', nargs='+', default=HEADS, choices=HEADS)
+    parser.add_argument('--nfeat', type=int, default=4096, help='Size of the synthetic features')
+    parser.add_argument('--nbatches', type=int, default=8,
+                        help='Minibatches per epoch at the largest batch size')
+    parser.add_argument('--epochs', type=int, default=3,
+                        help='Passes per measurement, the first one is a warm up')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+    if args.epochs < 2:
+        parser.error('--epochs must be at least 2, the first one is not measured')
+
+    result = run(args.adj_file, args.batch_sizes, args.collapse, args.heads, args.nfeat,
+                 args.nbatches, args.epochs)
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    for r in result['results']:
+        print("%(head)-8s %(mode)-15s bsz %(batch_size)4d collapse %(collapse)-5s "
+              "%(minibatches_per_sec)9.2f mb/s %(latency_per_sample_ms)8.3f ms/sample "
+              "%(peak_rss_mb)8.1f MB" % r)
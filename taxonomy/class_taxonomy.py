@@ -1,14 +1,38 @@
 """ Class for manipulating and viewing class taxonomy """
+import hashlib
 import pickle
 import re
 import os
-from ete2 import Tree
+import numpy as np
+
+# Bump when the compiled attributes below change so stale caches are rebuilt
+CACHE_VERSION = 1
+CACHED_ATTRS = ['adj', 'leafid_to_labelidx', 'labelidx_to_leafid', 'leafid_to_parentsid',
+                'internalid_to_childrenid', 'leafid_to_internallabels', 'node_ids', 'node_idx',
+                'node_parent', 'node_depth', 'child_offset', 'child_count', 'node_labelidx',
+                'max_depth', 'leaf_ancestors', 'leaf_child_index', 'leaf_path_indptr',
+                'leaf_path_indices']
 
 class ClassTaxonomy():
-    def __init__(self, root, adj_file, dataset_dir, collapse=True):
+    def __init__(self, root, adj_file, dataset_dir, collapse=True, cache_dir=None):
+        """
+        The compiled taxonomy is cached in cache_dir (defaults to dataset_dir) under a hash of
+        the adjacency pickle, classes.txt, root and collapse so later runs skip building the
+        ete2 tree. Pass cache_dir=False to always rebuild.
+        """
         self.root = root
         self.collapse = collapse
         self.dataset_dir = dataset_dir
+        self._tree = None
+
+        cache_file = None
+        if cache_dir is not False:
+            cache_file = self.cache_file(adj_file, cache_dir)
+            if os.path.exists(cache_file):
+                with open(cache_file, 'rb') as f:
+                    self.__dict__.update(pickle.load(f))
+                return
+
         # Adj is dict of parent : list of children
         adj = pickle.load(open(adj_file, 'rb'))
         self.adj = {}
@@ -16,11 +40,54 @@ class ClassTaxonomy():
         for k, v in adj.items():
             self.adj[''.join(re.findall("[a-zA-Z]+", k))] = [''.join(re.findall("[a-zA-Z]+", x)) for x in v]
 
-        self.tree = self.build_tree()
+        self._tree = self.build_tree()
         self.update_adj()
         self.make_helper_dicts()
+        self.make_index_arrays()
+
+        if cache_file is not None:
+            self.write_cache(cache_file)
+
+    def write_cache(self, cache_file):
+        # Write then rename so concurrent jobs never read a partial cache. A read only or
+        # shared dataset dir just means running without the cache.
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump({k: getattr(self, k) for k in CACHED_ATTRS}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            print('Not caching the taxonomy in %s: %s' % (cache_file, e))
+            if os.path.exists(tmp_file):
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+
+    @property
+    def classes_file(self):
+        return os.path.join(os.path.expanduser(self.dataset_dir), 'classes.txt')
+
+    def cache_file(self, adj_file, cache_dir=None):
+        h = hashlib.sha1()
+        for fname in [adj_file, self.classes_file]:
+            with open(fname, 'rb') as f:
+                h.update(f.read())
+        h.update(repr((self.root, self.collapse, CACHE_VERSION)))
+        cache_dir = os.path.expanduser(cache_dir or self.dataset_dir)
+        return os.path.join(cache_dir, 'taxonomy_cache_%s.p' % h.hexdigest())
+
+    @property
+    def tree(self):
+        # Only built on demand when loaded from cache, e.g. for tree.show()
+        if self._tree is None:
+            self._tree = self.build_tree()
+        return self._tree
 
     def build_tree(self):
+        from ete2 import Tree
+
         def build_children(parent):
             """ Construct tree string to load into ETE format ((A, B)C,(D,E)F)G"""
             if parent not in self.adj:
@@ -66,8 +133,7 @@ class ClassTaxonomy():
 
         # Leafid to labelidx is dict of leaf label_name : label_idx
         self.leafid_to_labelidx = {}
-        classes_file = os.path.join(os.path.expanduser(self.dataset_dir), 'classes.txt')
-        for idx, line in enumerate(open(classes_file,'r').readlines()):
+        for idx, line in enumerate(open(self.classes_file,'r').readlines()):
             self.leafid_to_labelidx[''.join(re.findall("[a-zA-Z]+", line))] = idx
         self.labelidx_to_leafid = {v: k for k, v in self.leafid_to_labelidx.items()}
 
@@ -94,6 +160,55 @@ class ClassTaxonomy():
         intersect = set([x.name for x in self.tree.get_leaves()]) - set(self.leafid_to_labelidx)
         assert len(intersect) == 0, intersect
 
+    def make_index_arrays(self):
+        """
+        Compile the taxonomy into dense integer arrays. Nodes are numbered breadth first from
+        the root so the children of every node get consecutive ids, and leaf rows are indexed
+        by label idx.
+        """
+        # Node id : name, parent id, depth and id of first child (-1 for leaves)
+        self.node_ids = [self.root]
+        parent, depth, child_offset = [-1], [0], []
+        n = 0
+        while n < len(self.node_ids):
+            children = self.internalid_to_childrenid.get(self.node_ids[n], [])
+            child_offset.append(len(self.node_ids) if children else -1)
+            self.node_ids.extend(children)
+            parent.extend([n] * len(children))
+            depth.extend([depth[n] + 1] * len(children))
+            n += 1
+        self.node_idx = {k: n for n, k in enumerate(self.node_ids)}
+        self.node_parent = np.array(parent, dtype=np.int64)
+        self.node_depth = np.array(depth, dtype=np.int64)
+        self.child_offset = np.array(child_offset, dtype=np.int64)
+        self.child_count = np.array([len(self.internalid_to_childrenid.get(k, []))
+                                     for k in self.node_ids], dtype=np.int64)
+        self.node_labelidx = np.array([self.leafid_to_labelidx.get(k, -1) for k in self.node_ids],
+                                      dtype=np.int64)
+
+        # Label idx : ids of the internal nodes on the path from the root (broadest first) and
+        # the idx of the path's child under each of them, -1 padded
+        nclass = len(self.leafid_to_labelidx)
+        self.max_depth = self.node_depth[self.node_labelidx >= 0].max()
+        self.leaf_ancestors = -np.ones((nclass, self.max_depth), dtype=np.int64)
+        self.leaf_child_index = -np.ones((nclass, self.max_depth), dtype=np.int64)
+        # Sparse (nclass, nnodes) leaf to node path matrix in CSR form, root to leaf inclusive
+        path_len = np.zeros(nclass, dtype=np.int64)
+        leaves = np.where(self.node_labelidx >= 0)[0]
+        path_len[self.node_labelidx[leaves]] = self.node_depth[leaves] + 1
+        self.leaf_path_indptr = np.concatenate([[0], np.cumsum(path_len)])
+        self.leaf_path_indices = np.zeros(self.leaf_path_indptr[-1], dtype=np.int64)
+        for j in leaves:
+            l = self.node_labelidx[j]
+            self.leaf_path_indices[self.leaf_path_indptr[l + 1] - 1] = j
+            while self.node_parent[j] >= 0:
+                p = self.node_parent[j]
+                d = self.node_depth[p]
+                self.leaf_ancestors[l, d] = p
+                self.leaf_child_index[l, d] = j - self.child_offset[p]
+                self.leaf_path_indices[self.leaf_path_indptr[l] + d] = p
+                j = p
+
 if __name__ == '__main__':
     ctree = ClassTaxonomy('Aves', 'taxonomy_dict.p', '~/NABirds')
     ctree.tree.show()
@@ -0,0 +1,126 @@
+"""
+Cache the outputs of the frozen layers of a network so only its trainable head has to run
+while training, e.g. when sweeping taxonomy variants on top of a frozen pretrained trunk.
+"""
+import os
+
+import numpy as np
+
+from neon import NervanaObject
+from neon.util.persist import load_obj, save_obj
+
+from layer import frozen_prefix_length
+from pipeline import prefetch
+
+
+def feature_files(prefix):
+    return prefix + '_features.npy', prefix + '_labels.npy', prefix + '_meta.pkl'
+
+
+def extract_features(layers, dataset, prefix, dtype=np.float32):
+    """
+    Runs the frozen leading layers of an initialized model once over dataset in inference mode
+    and stores their outputs, one row per record, in a memory mapped feature store. A finished
+    store with the same prefix is reused, delete it when the frozen weights change.
+
+    Arguments:
+        layers (list): Flat list of the model's layers, e.g. model.layers.layers
+        dataset (ImageLoader): Data to extract the features of, without random transforms
+        prefix (str): Path prefix of the store's files
+        dtype (np.dtype, optional): Storage type of the features, float16 halves the store
+
+    Returns:
+        The prefix of the store, to open with FeatureLoader.
+    """
+    feat_file, label_file, meta_file = feature_files(prefix)
+    if os.path.exists(meta_file):
+        return prefix
+    frozen = layers[:frozen_prefix_length(layers)]
+    if len(frozen) == 0:
+        raise ValueError("the model has no frozen layers to cache the features of")
+
+    nfeat = int(np.prod(frozen[-1].out_shape))
+    features = np.lib.format.open_memmap(feat_file, mode='w+', dtype=dtype,
+                                         shape=(dataset.ndata, nfeat))
+    labels = np.lib.format.open_memmap(label_file, mode='w+', dtype=np.int32,
+                                       shape=(dataset.ndata,))
+    dataset.reset()
+    start = 0
+    for x, t in dataset:
+        for l in frozen:
+            x = l.fprop(x, inference=True)
+        # The last minibatch of a loader wraps around to the first records
+        n = min(dataset.ndata - start, x.shape[1])
+        features[start:start + n] = x.get()[:, :n].T
+        labels[start:start + n] = dataset.labels[dataset.idx].get()[0, :n]
+        start += n
+    features.flush()
+    labels.flush()
+    del features, labels
+
+    # Written last, a store without its meta file is incomplete
+    save_obj({'ndata': dataset.ndata, 'nclass': dataset.nclass,
+              'shape': frozen[-1].out_shape}, meta_file)
+    return prefix
+
+
+def head_model(model, dataset):
+    """
+    A model made of the trainable layers of model, which trains on the features of its frozen
+    layers provided by dataset. Heads which read their labels from a data loader are pointed
+    at dataset.
+    """
+    layers = model.layers.layers
+    head = layers[frozen_prefix_length(layers):]
+    for l in head:
+        if hasattr(l, 'img_loader'):
+            l.img_loader = dataset
+    return type(model)(layers=head)
+
+
+class FeatureLoader(NervanaObject):
+
+    """
+    Iterates over a feature store written by extract_features like an ImageLoader does over
+    macrobatches, yielding the features and one hot labels of each minibatch. Like the
+    ImageLoader, the last minibatch is filled up with the first records.
+
+    Arguments:
+        prefix (str): Path prefix of the store
+    """
+
+    def __init__(self, prefix):
+        feat_file, label_file, meta_file = feature_files(prefix)
+        meta = load_obj(meta_file)
+        self.features = np.load(feat_file, mmap_mode='r')
+        self.np_labels = np.load(label_file, mmap_mode='r')
+        self.ndata = meta['ndata']
+        self.nclass = meta['nclass']
+        self.shape = meta['shape']
+        self.nbatches = -(-self.ndata // self.be.bsz)
+        self.idx = 0
+
+        self.data = self.be.iobuf(self.features.shape[1])
+        self.labels = self.be.iobuf(1, dtype=np.int32)
+        self.onehot_labels = self.be.iobuf(self.nclass)
+
+    def reset(self):
+        pass
+
+    def _host_batches(self):
+        bsz = self.be.bsz
+        for start in range(0, self.ndata, bsz):
+            if start + bsz <= self.ndata:
+                rows = slice(start, start + bsz)
+            else:
+                rows = np.arange(start, start + bsz) % self.ndata
+            yield (np.ascontiguousarray(self.features[rows].T, dtype=self.be.default_dtype),
+                   np.array(self.np_labels[rows]).reshape((1, bsz)))
+
+    def __iter__(self):
+        # The next minibatch is read from the store while the current one is in use
+        for data, labels in prefetch(self._host_batches()):
+            self.data.set(data)
+            self.labels.set(labels)
+            self.be.onehot(self.labels, axis=0, out=self.onehot_labels)
+            yield self.data, self.onehot_labels
@@ -1,9 +1,176 @@
+import numpy as np
+
+from neon import NervanaObject
 from neon.layers.container import LayerContainer, Sequential, BranchNode
 from neon.layers.layer import interpret_in_shape, Layer, Linear, Bias, Activation, BatchNorm
 
+from profiler import NULL_PROFILER
+
+
+def child_rows(ctree):
+    """
+    (nnodes, max children) rows of each node's children in the stacked outputs of all node
+    classifiers, -1 padded. Every node but the root owns row (node id - 1).
+    """
+    rows = ctree.child_offset[:, None] - 1 + np.arange(ctree.child_count.max())
+    rows[np.arange(ctree.child_count.max()) >= ctree.child_count[:, None]] = -1
+    return rows
+
+
+def path_matrices(ctree, max_depth=None):
+    """
+    (nrows, nclass) host matrices over the stacked node outputs. Column l of targets has a 1 in
+    the row of every node on the path from the root to leaf l, and column l of masks covers
+    the rows of every classifier on that path. With max_depth only the broadest max_depth
+    classifiers of each path are included.
+    """
+    nclass = ctree.leaf_ancestors.shape[0]
+    targets = np.zeros((len(ctree.node_ids) - 1, nclass), dtype=np.float32)
+    masks = np.zeros((len(ctree.node_ids) - 1, nclass), dtype=np.float32)
+    path_len = np.diff(ctree.leaf_path_indptr)
+    leaves = np.repeat(np.arange(nclass), path_len)
+    nodes = ctree.leaf_path_indices
+    keep = nodes > 0
+    if max_depth is not None:
+        keep &= ctree.node_depth[nodes] <= max_depth
+    targets[nodes[keep] - 1, leaves[keep]] = 1
+
+    ancestors = ctree.leaf_ancestors[:, :max_depth]
+    rows = child_rows(ctree)[ancestors]
+    cols = np.repeat(np.arange(nclass), rows.shape[1] * rows.shape[2]).reshape(rows.shape)
+    valid = (ancestors[:, :, None] >= 0) & (rows >= 0)
+    masks[rows[valid], cols[valid]] = 1
+    return targets, masks
+
+
+def node_path_matrix(ctree):
+    """
+    (nrows, nrows) host matrix over the stacked node outputs. Row r has a 1 in the row of every
+    node on the path from the root to node r + 1, inclusive.
+    """
+    nrows = len(ctree.node_ids) - 1
+    paths = np.zeros((nrows, nrows), dtype=np.float32)
+    # Breadth first ids number every parent before its children
+    for j in range(1, nrows + 1):
+        if ctree.node_parent[j] > 0:
+            paths[j - 1] = paths[ctree.node_parent[j] - 1]
+        paths[j - 1, j - 1] = 1
+    return paths
+
+
+class DepthTopK(object):
+
+    """
+    Host metric giving the top k accuracy of a tree head at every depth of the taxonomy, from
+    the stacked node probabilities of a minibatch (see node_probs of the heads) and its one hot
+    leaf targets. A node scores the product of the probabilities along its path. At depth d
+    the candidates are the nodes at depth d and the leaves above it, i.e. every leaf's path is
+    cut at depth d, so the deepest level is the leaf accuracy.
+
+    Arguments:
+        ctree (ClassTaxonomy): Class taxonomy the head was built from
+        ks (list, optional): k of each reported accuracy. Defaults to (1, 5).
+    """
+
+    name = 'depth_topk'
+
+    def __init__(self, ctree, ks=(1, 5)):
+        self.ks = list(ks)
+        self.paths = node_path_matrix(ctree)
+        depth = ctree.node_depth[1:]
+        is_leaf = ctree.node_labelidx[1:] >= 0
+        self.depths = range(1, depth.max() + 1)
+        self.candidates = [np.where((depth == d) | (is_leaf & (depth < d)))[0]
+                           for d in self.depths]
+
+        # Row of each leaf's node at every depth, the leaf itself below its own depth. Labels
+        # without a path in the taxonomy get -1 and are a miss at every depth.
+        nclass = ctree.leaf_ancestors.shape[0]
+        self.truth = -np.ones((len(self.depths), nclass), dtype=np.int64)
+        for l in range(nclass):
+            path = ctree.leaf_path_indices[ctree.leaf_path_indptr[l]:ctree.leaf_path_indptr[l + 1]]
+            if len(path) == 0:
+                continue
+            for d in self.depths:
+                self.truth[d - 1, l] = path[min(d, len(path) - 1)] - 1
+        self.metric_names = ['depth%d_top%d' % (d, k) for d in self.depths for k in self.ks]
+
+    def __call__(self, probs, targets):
+        """ (len(metric_names), samples) hits of every depth and k """
+        labels = targets.argmax(axis=0)
+        cols = np.arange(len(labels))
+        scores = np.dot(self.paths, np.log(np.maximum(probs, 1e-30)))
+        hits = []
+        for d, cand in zip(self.depths, self.candidates):
+            truth = self.truth[d - 1, labels]
+            rank = (scores[cand] > scores[truth, cols]).sum(axis=0)
+            hits.extend((rank < k) & (truth >= 0) for k in self.ks)
+        return np.array(hits, dtype=np.float32)
+
+
+def beam_search(log_probs, rows, labelidx, beam_width, expand=None):
+    """
+    Top k beam search down the class taxonomy for a whole minibatch at once.
+
+    Arguments:
+        log_probs (ndarray): (nrows, bsz) host log probs of the stacked node outputs
+        rows (ndarray): Child rows of each node as returned by child_rows
+        labelidx (ndarray): Label idx of each node, -1 for internal nodes
+        beam_width (int): Number of partial paths kept per data point
+        expand (callable, optional): Called with the ids of the internal nodes about to be
+            expanded, so their rows of log_probs can be filled in lazily
+
+    Returns:
+        (bsz, beam_width) label idxs of the best leaves and their path log probs, best first.
+        Beams which could not be filled have a log prob of -inf and a label idx of -1.
+    """
+    bsz = log_probs.shape[1]
+    cols = np.arange(bsz)[:, None]
+    nodes = np.zeros((bsz, 1), dtype=np.int64)
+    scores = np.zeros((bsz, 1))
+    while True:
+        cand_rows = rows[nodes]
+        # Empty beams hold the root with a log prob of -inf and are finished like leaves,
+        # else they would be expanded again forever when there are fewer leaves than beams
+        is_leaf = (cand_rows[:, :, 0] < 0) | np.isneginf(scores)
+        if is_leaf.all():
+            return np.where(np.isneginf(scores), -1, labelidx[nodes]), scores
+        if expand is not None:
+            expand(np.unique(nodes[~is_leaf]))
+
+        # Leaves are carried over unchanged as their own single candidate
+        valid = (cand_rows >= 0) & ~is_leaf[:, :, None]
+        cand_nodes = np.where(valid, cand_rows + 1, 0)
+        cand_scores = np.where(valid, scores[:, :, None] + log_probs[cand_rows, cols[:, :, None]],
+                               -np.inf)
+        cand_nodes[:, :, 0] = np.where(is_leaf, nodes, cand_nodes[:, :, 0])
+        cand_scores[:, :, 0] = np.where(is_leaf, scores, cand_scores[:, :, 0])
+
+        cand_nodes = cand_nodes.reshape(bsz, -1)
+        cand_scores = cand_scores.reshape(bsz, -1)
+        order = np.argsort(-cand_scores, axis=1, kind='mergesort')[:, :beam_width]
+        nodes = cand_nodes[cols, order]
+        scores = cand_scores[cols, order]
+
+
+def frozen_prefix_length(layers):
+    """
+    Number of leading layers of a flat layer list which have no trainable parameters, i.e.
+    the part of a network whose outputs do not change while the rest of it trains.
+    """
+    for i, l in enumerate(layers):
+        if isinstance(l, LayerContainer) or (l.has_params and l.optimize):
+            return i
+    return len(layers)
+
+
 class FreezeSequential(Sequential):
     """
-    Layer container that encapsulates a simple linear pathway of layers.
+    Layer container that encapsulates a simple linear pathway of layers whose leading layers
+    are frozen. The frozen prefix, up to the first layer with trainable parameters, is found
+    once in configure. It always runs in inference mode (so dropout and batch norm behave
+    like in the pretrained network) and gets no delta buffers or bprop; neither does the
+    input of the first trainable layer.
 
     Arguments:
         layers (list): List of objects which can be either a list of layers (including layer
@@ -19,15 +186,43 @@ class FreezeSequential(Sequential):
                 lto.append(l)
         return lto
 
+    def configure(self, in_obj):
+        super(FreezeSequential, self).configure(in_obj)
+        cut = frozen_prefix_length(self.layers)
+        self.frozen_layers = self.layers[:cut]
+        self.trainable_layers = self.layers[cut:]
+        self._trainable = [l for l in self.trainable_layers if type(l) is not BranchNode]
+        return self
+
+    def allocate(self, shared_outputs=None, shared_deltas=None):
+        # Size and hand out the delta buffers over the trainable layers only
+        all_layers = self._layers
+        self._layers = self._trainable
+        try:
+            super(FreezeSequential, self).allocate(shared_outputs, shared_deltas)
+        finally:
+            self._layers = all_layers
+        if len(self.frozen_layers) > 0:
+            for l in self.frozen_layers:
+                l.deltas = None
+            if len(self._trainable) > 0 and not isinstance(self._trainable[0], LayerContainer):
+                self._trainable[0].deltas = None
+
+    def fprop(self, inputs, inference=False):
+        x = inputs
+        for l in self.frozen_layers:
+            x = l.fprop(x, inference=True)
+        for l in self.trainable_layers:
+            x = l.fprop(x, inference)
+        return x
+
     def bprop(self, error, alpha=1.0, beta=0.0):
-        for l in reversed(self._layers):
-            if l.has_params and not l.optimize:
-                return
-            if type(l.prev_layer) is BranchNode or l is self._layers[0]:
+        for l in reversed(self._trainable):
+            if type(l.prev_layer) is BranchNode or l is self._trainable[0]:
                 error = l.bprop(error, alpha, beta)
             else:
                 error = l.bprop(error)
-        return self._layers[0].deltas
+        return self._trainable[0].deltas
 
 class TaxonomicBranch(LayerContainer):
 
@@ -41,18 +236,46 @@ class TaxonomicBranch(LayerContainer):
         init (Initializer, optional): Initializer object to use for
             initializing layer weights
         name (str, optional): Layer name. Defaults to "LinearLayer"
+        grouped (bool, optional): If True, bucket the minibatch by internal node and run each
+            node classifier once over the whole minibatch, masking out the columns not routed
+            to it, so a step costs (nodes reached) x bsz columns. Otherwise each data point is
+            propagated separately. Defaults to False.
+        inference_mode (str, optional): 'greedy' predicts the leaf reached by following the
+            argmax at every node, 'marginal' scores every leaf by the product of the node
+            probabilities along its path and 'beam' scores the leaves found by a top k beam
+            search. The last two require grouped. Defaults to 'greedy'.
+        beam_width (int, optional): Number of paths kept by the beam search. Defaults to 5.
+        arena (bool, optional): If True, the weights, biases and gradients of all the node
+            classifiers are views into one ParamArena per layer type, ordered breadth first.
+            Defaults to False.
     """
 
-    def __init__(self, layer_container, cost_container, ctree, img_loader, name="LinearLayer"):
+    # Replaced by attach_profiler
+    profiler = NULL_PROFILER
+
+    def __init__(self, layer_container, cost_container, ctree, img_loader, name="LinearLayer",
+                 grouped=False, inference_mode='greedy', beam_width=5, arena=False):
         super(TaxonomicBranch, self).__init__(name)
         self.nout = len(layer_container)
-        self.inputs = None
+        self.input_src = None
         self.layers = layer_container
         self.costs = cost_container
         self.ctree = ctree
         self.has_params = False
         self.img_loader = img_loader
         self.optimize = True
+        self.grouped = grouped
+        if inference_mode not in ('greedy', 'marginal', 'beam'):
+            raise NotImplementedError(inference_mode + " inference has not been implemented")
+        if inference_mode != 'greedy' and not grouped:
+            raise NotImplementedError(inference_mode + " inference requires a grouped branch")
+        self.inference_mode = inference_mode
+        self.beam_width = beam_width
+        self.arena = arena
+        self.arenas = None
+        # Internal nodes whose classifiers received gradients from the last minibatch, None
+        # until the first one
+        self.touched = None
 
     @property
     def layers_to_optimize(self):
@@ -98,29 +321,82 @@ class TaxonomicBranch(LayerContainer):
         for l in obj:
             l.set_deltas(delta_buffer)
 
+    @property
+    def node_bsz(self):
+        # Node classifiers see the whole minibatch in grouped mode, one data point otherwise
+        return self.be.bsz if self.grouped else 1
+
     def set_deltas(self, delta_buffer):
         old_bsz = self.be.bsz
-        self.be.bsz = 1
+        self.be.bsz = self.node_bsz
         for v in self.layers.values():
             self._do_set_deltas(v, delta_buffer)
         self.be.bsz = old_bsz
 
     def allocate(self, shared_outputs=None, shared_deltas=None):
         self.deltas = self.be.iobuf(self.in_shape)
-        self.inputs = [self.be.zeros((self.nin, 1)) for _ in range(self.be.bsz)]
+        self.delta_cols = [self.deltas[:, i] for i in range(self.be.bsz)]
+        self.total_cost = self.be.zeros((1, 1))
 
         self.leaf_preds = self.be.iobuf(len(self.ctree.labelidx_to_leafid))
         self.root_preds = self.be.iobuf(len(self.ctree.internalid_to_childrenid[self.ctree.root]))
         self.root_targets = self.be.iobuf(len(self.ctree.internalid_to_childrenid[self.ctree.root]))
 
+        if self.arena and self.arenas is None:
+            self.allocate_arenas()
+
         old_bsz = self.be.bsz
-        self.be.bsz = 1
-        self.targets = {}
-        for k, v in self.layers.items():
+        self.be.bsz = self.node_bsz
+        for v in self.layers.values():
             self._do_allocate(v)
-            self.targets[k] = self.be.zeros(v[-1].out_shape)
         self.be.bsz = old_bsz
 
+        # One hot targets of every node classifier for the whole minibatch, stacked like
+        # node_probs, and each internal node's column mask. Both are set with one transfer per
+        # minibatch, the buffers of the nodes are row views into them.
+        internal = np.where(self.ctree.child_offset >= 0)[0]
+        self.mask_row = np.cumsum(self.ctree.child_offset >= 0) - 1
+        self.stacked_targets = self.be.iobuf(len(self.ctree.node_ids) - 1)
+        self.np_targets = np.zeros(self.stacked_targets.shape, dtype=np.float32)
+        self.targets = {}
+        self.target_cols = {}
+        if self.grouped:
+            self.stacked_masks = self.be.iobuf(len(internal))
+            self.np_masks = np.zeros(self.stacked_masks.shape, dtype=np.float32)
+            self.masks = {}
+        for n in internal:
+            k = self.ctree.node_ids[n]
+            base, row = int(self.ctree.child_offset[n] - 1), int(self.mask_row[n])
+            self.targets[k] = self.stacked_targets[base:base + int(self.ctree.child_count[n])]
+            if self.grouped:
+                self.masks[k] = self.stacked_masks[row:row + 1]
+
+        self.state = self.be.iobuf(1)
+        self.child_idx = self.be.iobuf(1)
+        self.stacked = self.be.iobuf(len(self.ctree.node_ids) - 1)
+        # Root child of every leaf, to map one hot leaf targets onto the root classifier.
+        # Leaves without one get an all zero column.
+        nroot = self.ctree.child_count[0]
+        root_child = self.ctree.leaf_child_index[:, 0]
+        root_paths = np.zeros((nroot, len(root_child)), dtype=np.float32)
+        root_paths[root_child[root_child >= 0], np.where(root_child >= 0)[0]] = 1
+        self.root_paths = self.be.array(root_paths)
+        self.root_idx = self.be.iobuf(1)
+        if self.inference_mode == 'marginal':
+            path_targets, _ = path_matrices(self.ctree)
+            self.path_targets = self.be.array(path_targets)
+        elif self.inference_mode == 'beam':
+            self.child_rows = child_rows(self.ctree)
+
+    def allocate_arenas(self):
+        # Breadth first, so the classifiers of a subtree sit close together
+        groups = {}
+        for k in self.ctree.node_ids:
+            for l in self.layers.get(k, []):
+                if l.has_params:
+                    groups.setdefault(l.__class__, []).append(l)
+        self.arenas = [ParamArena(v) for v in groups.values()]
+
     def configure(self, in_obj):
         assert isinstance(in_obj, Layer)
         self.prev_layer = in_obj
@@ -129,7 +405,7 @@ class TaxonomicBranch(LayerContainer):
         self.out_shape = self.in_shape
 
         old_bsz = self.be.bsz
-        self.be.bsz = 1
+        self.be.bsz = self.node_bsz
         for k in self.ctree.internalid_to_childrenid.keys():
             prev_input = self._do_configure(self.layers[k], self.prev_layer)
             self.costs[k].initialize(prev_input)
@@ -142,121 +418,530 @@ class TaxonomicBranch(LayerContainer):
         if inference:
             return self._fprop_inference(inputs)
         else:
-            return self._fprop(inputs)
+            with self.profiler.phase('fprop/head'):
+                return self._fprop(inputs)
+
+    def _columns(self, inputs):
+        """
+        (nin, 1) views of the columns of inputs for the per sample classifiers. They are kept
+        as long as the previous layer hands over the same output buffer.
+        """
+        if inputs is not self.input_src:
+            self.input_src = inputs
+            self.input_cols = [inputs[:, i] for i in range(self.be.bsz)]
+        return self.input_cols
+
+    def _descend(self, inputs, all_probs=None):
+        """
+        Level synchronous greedy descent of the whole minibatch. At each depth every node that
+        still has data points is evaluated once over the minibatch, and the argmax and the
+        transition to the chosen child are applied on device to the columns sitting at that node.
+        Returns the host copy of the final state, i.e. the node id of each data point's leaf.
+        Per sample classifiers are evaluated over the minibatch through _node_batch.
+
+        If all_probs is given, the host copy of each evaluated node output column is appended
+        to the list of its data point as (internal_id, probs).
+        """
+        self.state[:] = 0
+        while True:
+            # One small host transfer per level to find which nodes still have data points
+            state = self.state.get()[0].astype(np.int64)
+            self.profiler.transfer()
+            frontier = np.unique(state[self.ctree.child_offset[state] >= 0])
+            if len(frontier) == 0:
+                return state
+            for n in frontier:
+                base = self.ctree.child_offset[n] - 1
+                x = self._node_batch(self.ctree.node_ids[n], inputs,
+                                     self.stacked[base:base + self.ctree.child_count[n]])
+                if all_probs is not None:
+                    x_host = x.get()
+                    self.profiler.transfer()
+                    for i in np.where(state == n)[0]:
+                        all_probs[i].append((self.ctree.node_ids[n], x_host[:, i:i + 1]))
+                self.be.argmax(x, axis=0, out=self.child_idx)
+                # Host ints, so the backend tensor's operators build the op tree
+                self.state[:] = self.state + self.be.equal(self.state, int(n)) * \
+                    (int(self.ctree.child_offset[n] - n) + self.child_idx)
 
     def get_outputs(self, inputs):
-        preds = []
-        all_probs = []
-        for i in range(self.be.bsz):
-            # Copy column of inputs which is one data point
-            self.inputs[i][:] = inputs[:, i]
-            pred = [] # list of (internal_id, prob)
-            curr_id = self.ctree.root
-            # Continue predicting till we get to leaf node
-            prev_prob = 1.0
-            single_probs = []
-            while True:
-                x = self._do_fprop(self.layers[curr_id], self.inputs[i]).get()
-                single_probs.append((curr_id, x))
-                curr_idx = x.argmax()
-                prob = prev_prob * x[curr_idx, 0]
-                curr_id = self.ctree.internalid_to_childrenid[curr_id][curr_idx]
-                pred.append((curr_id, prob))
-                prev_prob = prob
-                if curr_id in self.ctree.leafid_to_internallabels:
-                    break
-            preds.append(pred)
-            all_probs.append(single_probs)
+        """ Per data point list of (internal_id, probs) of the nodes on its greedy path """
+        all_probs = [[] for _ in range(self.be.bsz)]
+        self._descend(inputs, all_probs)
         return all_probs
 
-    def _fprop_inference(self, inputs):
-        self.leaf_preds[:] = 0
-        preds = []
-        for i in range(self.be.bsz):
-            # Copy column of inputs which is one data point
-            self.inputs[i][:] = inputs[:, i]
-            pred = [] # list of (internal_id, prob)
-            curr_id = self.ctree.root
-            # Continue predicting till we get to leaf node
-            prev_prob = 1.0
-            while True:
-                x = self._do_fprop(self.layers[curr_id], self.inputs[i]).get()
-                curr_idx = x.argmax()
-                #prob = prev_prob * x[curr_idx, 0]
-                curr_id = self.ctree.internalid_to_childrenid[curr_id][curr_idx]
-                #pred.append((curr_id, prob))
-                #prev_prob = prob
-                if curr_id in self.ctree.leafid_to_internallabels:
-                    self.leaf_preds[self.ctree.leafid_to_labelidx[curr_id], i] = 1
-                    break
-            #preds.append(pred)
+    def _fprop_marginal(self, inputs):
+        """
+        Exact probability of every leaf: the node outputs are stacked and the log probs along
+        each leaf's path summed with one GEMM against the leaf path matrix.
+        """
+        self.node_probs(inputs)
+        self.stacked[:] = self.be.safelog(self.stacked)
+        self.be.compound_dot(A=self.path_targets.T, B=self.stacked, C=self.leaf_preds)
+        self.leaf_preds[:] = self.be.exp(self.leaf_preds)
         return self.leaf_preds
 
-    def get_root_preds(self, inputs, leaf_targets):
-        self.root_preds[:] = 0
-        self.root_targets[:] = 0
-        leaf_targets = leaf_targets.get().argmax(axis=0)
-
-        for i in range(self.be.bsz):
-            label_id = self.ctree.labelidx_to_leafid[leaf_targets[i]]
-            # Copy column of inputs which is one data point
-            self.inputs[i][:] = inputs[:, i]
+    def _node_batch(self, internalid, inputs, out):
+        """ Output of an internal node classifier over the whole minibatch, written to out """
+        if self.grouped:
+            out[:] = self._do_fprop(self.layers[internalid], inputs)
+            return out
+        # The classifiers are allocated for one data point, so apply their parameters directly
+        for i, l in enumerate(self.layers[internalid]):
+            if isinstance(l, Linear) and i == 0:
+                self.be.compound_dot(A=l.W, B=inputs, C=out)
+            elif isinstance(l, Bias):
+                out[:] = out + l.W
+            elif isinstance(l, Activation):
+                out[:] = l.transform(out)
+            else:
+                raise NotImplementedError(l.__class__.__name__ + " in a per sample node classifier")
+        return out
+
+    def node_probs(self, inputs):
+        """
+        Outputs of every node classifier over the whole minibatch, stacked like the rows of
+        TaxonomicFusedHead: each node but the root owns row (node id - 1).
+        """
+        for n in np.where(self.ctree.child_offset >= 0)[0]:
+            base = self.ctree.child_offset[n] - 1
+            self._node_batch(self.ctree.node_ids[n], inputs,
+                             self.stacked[base:base + self.ctree.child_count[n]])
+        return self.stacked
+
+    def _fprop_beam(self, inputs):
+        """ Scores the beam_width most probable leaves found by beam search, zero elsewhere """
+        log_probs = np.zeros((len(self.ctree.node_ids) - 1, self.be.bsz), dtype=np.float32)
+
+        def expand(nodes):
+            for n in nodes:
+                base = self.ctree.child_offset[n] - 1
+                x = self._do_fprop(self.layers[self.ctree.node_ids[n]], inputs).get()
+                self.profiler.transfer()
+                log_probs[base:base + self.ctree.child_count[n]] = np.log(np.maximum(x, 1e-30))
+
+        leaves, scores = beam_search(log_probs, self.child_rows, self.ctree.node_labelidx,
+                                     self.beam_width, expand)
+        leaf_preds = np.zeros(self.leaf_preds.shape, dtype=np.float32)
+        found = np.isfinite(scores)
+        leaf_preds[leaves[found], np.where(found)[0]] = np.exp(scores[found])
+        self.leaf_preds.set(leaf_preds)
+        self.profiler.transfer()
+        return self.leaf_preds
 
-            x = self._do_fprop(self.layers[self.ctree.root], self.inputs[i]).get()
-            curr_idx = x.argmax()
-            self.root_preds[curr_idx, i] = 1
-            self.root_targets[self.ctree.leafid_to_internallabels[label_id][0][1], i] = 1
+    def _fprop_inference(self, inputs):
+        if self.inference_mode == 'marginal':
+            return self._fprop_marginal(inputs)
+        elif self.inference_mode == 'beam':
+            return self._fprop_beam(inputs)
+        state = self._descend(inputs)
+        leaf_preds = np.zeros(self.leaf_preds.shape, dtype=np.float32)
+        leaf_preds[self.ctree.node_labelidx[state], np.arange(len(state))] = 1
+        self.leaf_preds.set(leaf_preds)
+        self.profiler.transfer()
+        return self.leaf_preds
 
+    def get_root_preds(self, inputs, leaf_targets):
+        """ One hot predictions and targets of the root classifier, computed on device """
+        root = self._node_batch(self.ctree.root, inputs,
+                                self.stacked[:self.ctree.child_count[0]])
+        # A single one per column, ties go to the first child
+        self.be.argmax(root, axis=0, out=self.root_idx)
+        self.be.onehot(self.root_idx, axis=0, out=self.root_preds)
+        self.be.compound_dot(A=self.root_paths, B=leaf_targets, C=self.root_targets)
         return self.root_preds, self.root_targets
 
     def zero_gradients(self):
-        for lst in self.layers.values():
-            for l in lst:
+        if self.arenas and (self.touched is None or 2 * len(self.touched) > len(self.layers)):
+            for a in self.arenas:
+                a.dW[:] = 0
+            return
+        # Only the classifiers trained on the last minibatch can have gradients left
+        nodes = self.layers.keys() if self.touched is None else self.touched
+        for k in nodes:
+            for l in self.layers[k]:
                 if l.has_params:
                     l.dW[:] = 0
 
+    # Only the broadest train_depth classifiers on each leaf's path are trained
+    train_depth = 1
+
+    def _route(self, labels):
+        """
+        Internal node ids, child idxs and minibatch columns of the classifiers trained on each
+        data point, ordered by column then depth. The one hot targets of all of them (and in
+        grouped mode the node column masks) are set in bulk.
+        """
+        nodes = self.ctree.leaf_ancestors[labels, :self.train_depth]
+        lbls = self.ctree.leaf_child_index[labels, :self.train_depth]
+        cols = np.repeat(np.arange(len(labels)), nodes.shape[1]).reshape(nodes.shape)
+        valid = nodes >= 0
+        nodes, lbls, cols = nodes[valid], lbls[valid], cols[valid]
+
+        self.np_targets.fill(0)
+        self.np_targets[self.ctree.child_offset[nodes] - 1 + lbls, cols] = 1
+        self.stacked_targets.set(self.np_targets)
+        if self.grouped:
+            self.np_masks.fill(0)
+            self.np_masks[self.mask_row[nodes], cols] = 1
+            self.stacked_masks.set(self.np_masks)
+        self.profiler.transfer(2 if self.grouped else 1)
+        return nodes, lbls, cols
+
+    def _target_col(self, internalid, i):
+        # Views are made once and reused for every minibatch
+        key = (internalid, i)
+        if key not in self.target_cols:
+            self.target_cols[key] = self.targets[internalid][:, i]
+        return self.target_cols[key]
+
     def _fprop(self, inputs):
+        if self.grouped:
+            return self._fprop_grouped(inputs)
         self.zero_gradients()
         # Get lead node label idxs from img loader
-        temp_lbl = self.img_loader.labels[self.img_loader.idx].get()[0]
-        self.total_cost = self.be.zeros((1, 1))
-        self.cost = self.be.zeros((1, 1))
+        labels = self.img_loader.labels[self.img_loader.idx].get()[0].astype(np.int64)
+        prof = self.profiler
+        prof.transfer()
+        self.total_cost[:] = 0
+        self.deltas[:] = 0
+        nodes, _, cols = self._route(labels)
+        inputs = self._columns(inputs)
+        self.touched = set()
+
+        # Fprop each data point through the internal nodes its label falls under
+        for n, i in zip(nodes, cols):
+            internalid = self.ctree.node_ids[n]
+            self.touched.add(internalid)
+            if prof.enabled:
+                start = prof.clock()
+            targets = self._target_col(internalid, i)
+            x = self._do_fprop(self.layers[internalid], inputs[i])
+
+            cost = self.costs[internalid].get_cost(x, targets)
+            self.total_cost[:] = self.total_cost + cost
+
+            delta = self.costs[internalid].get_errors(x, targets)
+            if prof.enabled:
+                mid = prof.clock()
+            # Accumulate gradients
+            self.delta_cols[i][:] = self.delta_cols[i] + \
+                self._do_bprop(self.layers[internalid], delta)
+            if prof.enabled:
+                prof.node(internalid, 1, mid - start, prof.clock() - mid)
+
+        self.total_cost[:] = self.total_cost / self.be.bsz
+        return self.total_cost
+
+    def _fprop_grouped(self, inputs):
+        self.zero_gradients()
+        labels = self.img_loader.labels[self.img_loader.idx].get()[0].astype(np.int64)
+        prof = self.profiler
+        prof.transfer()
+        self.total_cost[:] = 0
         self.deltas[:] = 0
 
-        # Iterate over each data point in batch
-        for i in range(self.be.bsz):
-            label_idx = temp_lbl[i]
-            label_id = self.ctree.labelidx_to_leafid[label_idx]
-            self.inputs[i][:] = inputs[:, i]
-            # Fprop all internal nodes label idx falls under
-            self.cost[:] = 0
+        # Bucket the columns of the minibatch by the internal nodes they are routed to. Each
+        # reached node still runs over all bsz columns, with the others masked out, rather
+        # than over a gathered buffer of its own columns: the node layers and costs are
+        # allocated for a fixed batch size while bucket sizes change every minibatch, and a
+        # few large GEMMs beat many small ones for the nodes near the root, which get most
+        # of the columns. train_depth bounds the nodes reached per minibatch.
+        nodes, _, _ = self._route(labels)
+        self.touched = set(self.ctree.node_ids[n] for n in np.unique(nodes))
+
+        for n in np.unique(nodes):
+            if prof.enabled:
+                start = prof.clock()
+            internalid = self.ctree.node_ids[n]
+            x = self._do_fprop(self.layers[internalid], inputs)
+            # Columns not routed to this node have all zero targets so contribute no cost
+            # and the mean over the minibatch equals the per data point sum / bsz
+            cost = self.costs[internalid].get_cost(x, self.targets[internalid])
+            self.total_cost[:] = self.total_cost + cost
+
+            delta = self.costs[internalid].get_errors(x, self.targets[internalid])
+            delta[:] = delta * self.masks[internalid]
+            if prof.enabled:
+                mid = prof.clock()
+            self.deltas[:] = self.deltas + self._do_bprop(self.layers[internalid], delta)
+            if prof.enabled:
+                prof.node(internalid, (nodes == n).sum(), mid - start, prof.clock() - mid)
 
+        return self.total_cost
 
-            for internalid, internallbl in self.ctree.leafid_to_internallabels[label_id]:
-                # Convert label idx to 1 hot encoding
-                targets = self.targets[internalid]
-                targets[:] = 0
-                targets[internallbl] = 1
-                x = self._do_fprop(self.layers[internalid],  self.inputs[i])
+    def bprop(self, error):
+        return self.deltas
 
-                cost = self.costs[internalid].get_cost(x, targets)
-                self.cost[:] = self.cost + cost
 
-                delta = self.costs[internalid].get_errors(x, targets)
-                # Accumulate gradients
-                self.deltas[:, i] = self.deltas[:, i] + self._do_bprop(self.layers[internalid], delta)
-                break
+class TaxonomicFusedHead(LayerContainer):
 
-            self.total_cost[:] = self.total_cost + self.cost
+    """
+    Output head which concatenates the classifiers of every internal node in the class taxonomy
+    into a single (sum of children, nin) weight matrix. One GEMM scores every node, a segmented
+    softmax normalizes each node's children and the cross entropy is masked to the nodes on each
+    data point's ancestor path.
 
-        #self.deltas[:] = self.deltas / len(self.ctree.leafid_to_parentsid[label_id])
+    Arguments:
+        ctree (ClassTaxonomy): Class taxonomy providing the internal nodes and leaf paths
+        img_loader (ImageLoader): Data loader which provides the leaf label idxs
+        init (Initializer): Initializer object to use for initializing the weights
+        bias (Initializer, optional): Initializer for the biases. Defaults to no bias.
+        name (str, optional): Layer name. Defaults to "FusedHeadLayer"
+        inference_mode (str, optional): 'greedy', 'marginal' or 'beam', see TaxonomicBranch.
+            Defaults to 'greedy'.
+        beam_width (int, optional): Number of paths kept by the beam search. Defaults to 5.
+    """
 
-        self.total_cost[:] = self.total_cost / self.be.bsz
+    # Replaced by attach_profiler
+    profiler = NULL_PROFILER
+
+    # Only the broadest train_depth classifiers on each leaf's path are trained, all of them if
+    # None. Read by allocate.
+    train_depth = None
+
+    def __init__(self, ctree, img_loader, init, bias=None, name="FusedHeadLayer",
+                 inference_mode='greedy', beam_width=5):
+        super(TaxonomicFusedHead, self).__init__(name)
+        self.ctree = ctree
+        self.img_loader = img_loader
+        self.has_params = False
+        self.optimize = True
+        if inference_mode not in ('greedy', 'marginal', 'beam'):
+            raise NotImplementedError(inference_mode + " inference has not been implemented")
+        self.inference_mode = inference_mode
+        self.beam_width = beam_width
+
+        # Each node but the root owns one row of the fused weight matrix, numbered breadth
+        # first so every internal node's children form a contiguous segment
+        self.nout = len(self.ctree.node_ids) - 1
+
+        self.layers = [Linear(self.nout, init, name=name + '_linear')]
+        if bias is not None:
+            self.layers.append(Bias(init=bias, name=name + '_bias'))
+        self._make_index()
+
+    def _make_index(self):
+        """ Host side matrices mapping leaves and nodes onto rows of the fused output """
+        internal = np.where(self.ctree.child_offset >= 0)[0]
+        # segments[n, r] is 1 if row r belongs to the n-th internal node
+        self.np_segments = np.zeros((len(internal), self.nout), dtype=np.float32)
+        for n, j in enumerate(internal):
+            base = self.ctree.child_offset[j] - 1
+            self.np_segments[n, base:base + self.ctree.child_count[j]] = 1
+        self.child_rows = child_rows(self.ctree)
+        # Rows gathered to take the max of each segment: slot j of every internal node, slot
+        # major, with the slots past a node's children repeating its first child
+        rows = self.child_rows[internal]
+        self.np_slot_rows = np.where(rows >= 0, rows, rows[:, :1]).T.ravel().astype(np.int32)
+        self.np_path_targets, _ = path_matrices(self.ctree)
+
+    @property
+    def layers_to_optimize(self):
+        return [l for l in self.layers if l.has_params]
+
+    def configure(self, in_obj):
+        assert isinstance(in_obj, Layer)
+        self.prev_layer = in_obj
+        self.in_shape = in_obj.out_shape
+        (self.nin, self.nsteps) = interpret_in_shape(self.in_shape)
+        self.out_shape = self.in_shape
+
+        prev_input = in_obj
+        for l in self.layers:
+            prev_input = l.configure(prev_input)
+        return self
+
+    def allocate(self, shared_outputs=None, shared_deltas=None):
+        for l in self.layers:
+            l.allocate()
+        # Gradients are written straight into the head's own delta buffer
+        self.deltas = self.be.iobuf(self.in_shape)
+        self.layers[0].deltas = self.deltas
+
+        nclass = len(self.ctree.labelidx_to_leafid)
+        self.segments = self.be.array(self.np_segments)
+        self.path_targets = self.be.array(self.np_path_targets)
+        train_targets, train_masks = path_matrices(self.ctree, self.train_depth)
+        self.train_targets = self.be.array(train_targets)
+        self.train_masks = self.be.array(train_masks)
+
+        self.probs = self.be.iobuf(self.nout)
+        self.segment_sums = self.be.iobuf(self.np_segments.shape[0])
+        nseg, bsz = self.np_segments.shape[0], self.be.bsz
+        self.slot_rows = self.be.array(self.np_slot_rows, dtype=np.int32)
+        self.slots = self.be.iobuf(len(self.np_slot_rows))
+        self.segment_max = self.be.iobuf(nseg)
+        # (slots, segments * bsz) and (1, segments * bsz) views to reduce over the slots
+        self.slots_flat = self.slots.reshape((len(self.np_slot_rows) // nseg, nseg * bsz))
+        self.segment_max_flat = self.segment_max.reshape((1, nseg * bsz))
+        self.denoms = self.be.iobuf(self.nout)
+        self.targets = self.be.iobuf(self.nout)
+        self.masks = self.be.iobuf(self.nout)
+        self.errors = self.be.iobuf(self.nout)
+        self.onehot_labels = self.be.iobuf(nclass)
+        self.total_cost = self.be.zeros((1, 1))
+
+        self.leaf_preds = self.be.iobuf(nclass)
+        self.root_preds = self.be.iobuf(len(self.ctree.internalid_to_childrenid[self.ctree.root]))
+        self.root_targets = self.be.iobuf(len(self.ctree.internalid_to_childrenid[self.ctree.root]))
+        self.root_idx = self.be.iobuf(1)
+
+    def set_deltas(self, delta_buffer):
+        pass
+
+    def _fprop_probs(self, inputs, inference=False):
+        """ Scores every node with one GEMM and applies a softmax within each node's segment """
+        for l in self.layers:
+            inputs = l.fprop(inputs, inference)
+        # Shift each segment by its own max, scattered back over its rows, so no segment
+        # underflows, then normalize each segment by its own sum, which is at least 1
+        self.be.take(inputs, self.slot_rows, axis=0, out=self.slots)
+        self.be.max(self.slots_flat, axis=0, out=self.segment_max_flat)
+        self.be.compound_dot(A=self.segments.T, B=self.segment_max, C=self.denoms)
+        self.probs[:] = self.be.exp(inputs - self.denoms)
+        self.be.compound_dot(A=self.segments, B=self.probs, C=self.segment_sums)
+        self.be.compound_dot(A=self.segments.T, B=self.segment_sums, C=self.denoms)
+        self.probs[:] = self.probs / self.denoms
+        return self.probs
+
+    def fprop(self, inputs, inference=False):
+        if inference:
+            return self._fprop_inference(inputs)
+        else:
+            with self.profiler.phase('fprop/head'):
+                return self._fprop(inputs)
+
+    def _fprop(self, inputs):
+        self._fprop_probs(inputs)
+        # Expand the leaf labels into the targets and masks of every node on their paths
+        self.be.onehot(self.img_loader.labels[self.img_loader.idx], axis=0, out=self.onehot_labels)
+        self.be.compound_dot(A=self.train_targets, B=self.onehot_labels, C=self.targets)
+        self.be.compound_dot(A=self.train_masks, B=self.onehot_labels, C=self.masks)
+
+        self.total_cost[:] = self.be.mean(
+            self.be.sum(-self.targets * self.be.safelog(self.probs), axis=0), axis=1)
+        self.errors[:] = (self.probs - self.targets) * self.masks
         return self.total_cost
 
     def bprop(self, error):
+        with self.profiler.phase('bprop/head'):
+            error = self.errors
+            for l in reversed(self.layers):
+                error = l.bprop(error)
         return self.deltas
 
+    def _fprop_inference(self, inputs):
+        probs = self._fprop_probs(inputs, inference=True)
+        if self.inference_mode == 'marginal':
+            # Leaf log probs are the sums of the log probs along their paths
+            self.probs[:] = self.be.safelog(probs)
+            self.be.compound_dot(A=self.path_targets.T, B=self.probs, C=self.leaf_preds)
+            self.leaf_preds[:] = self.be.exp(self.leaf_preds)
+            return self.leaf_preds
+
+        # Greedy descent is a beam search of width one
+        beam_width = self.beam_width if self.inference_mode == 'beam' else 1
+        leaves, scores = beam_search(np.log(np.maximum(probs.get(), 1e-30)), self.child_rows,
+                                     self.ctree.node_labelidx, beam_width)
+        self.profiler.transfer()
+        leaf_preds = np.zeros(self.leaf_preds.shape, dtype=np.float32)
+        found = np.isfinite(scores)
+        if self.inference_mode == 'beam':
+            leaf_preds[leaves[found], np.where(found)[0]] = np.exp(scores[found])
+        else:
+            leaf_preds[leaves[:, 0], np.arange(leaves.shape[0])] = 1
+        self.leaf_preds.set(leaf_preds)
+        self.profiler.transfer()
+        return self.leaf_preds
+
+    def node_probs(self, inputs):
+        return self._fprop_probs(inputs, inference=True)
+
+    def get_root_preds(self, inputs, leaf_targets):
+        nroot = self.ctree.child_count[0]
+        root = self._fprop_probs(inputs, inference=True)[:nroot]
+        self.be.argmax(root, axis=0, out=self.root_idx)
+        self.be.onehot(self.root_idx, axis=0, out=self.root_preds)
+        self.be.compound_dot(A=self.path_targets[:nroot], B=leaf_targets,
+                             C=self.root_targets)
+        return self.root_preds, self.root_targets
+
+
+class ParamArena(NervanaObject):
+
+    """
+    Flat buffers holding the weights, gradients and momentum of many small parameter layers,
+    so zeroing and optimizer updates of all of them are single operations over contiguous
+    memory. Each layer's W, dW and states are reshaped views into the buffers, so code working
+    on the single layers is unaffected. The arena has the parameter layer interface an
+    optimizer needs and can be passed to one in place of its layers.
+
+    Arguments:
+        layers (list): Configured, unallocated parameter layers, all updated by one optimizer
+    """
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.name = layers[0].name
+        self.has_params = True
+        self.optimize = True
+        sizes = [int(np.prod(l.weight_shape)) for l in layers]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.W = self.be.empty((int(self.offsets[-1]), 1))
+        self.dW = self.be.zeros((int(self.offsets[-1]), 1))
+        self.states = []
+        self.host = None
+        self.index = {}
+        for i, l in enumerate(layers):
+            self.index[id(l)] = i
+            l.W = self._view(self.W, i)
+            l.dW = self._view(self.dW, i)
+            l.states = []
+            l.arena = self
+            # As ParameterLayer.init_params would have, which allocate now skips
+            l.init.fill(l.W)
+
+    def _view(self, buf, i):
+        rows = slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+        return buf[rows].reshape(self.layers[i].weight_shape)
+
+    def get_params(self):
+        return ((self.W, self.dW), self.states)
+
+    def share_velocity(self):
+        """
+        Creates the momentum buffer an optimizer would, and makes each layer's velocity a view
+        into it, keeping any velocity the layers already have.
+        """
+        if len(self.states) > 0:
+            return
+        self.states.append(self.be.zeros_like(self.W))
+        for i, l in enumerate(self.layers):
+            view = self._view(self.states[0], i)
+            if len(l.states) > 0:
+                view[:] = l.states[0]
+            l.states = [view]
+
+    def fetch(self, keep_states=False):
+        """ Copies the arena to the host in one transfer, for get_params_serialize """
+        self.host = [self.W.get()] + ([s.get() for s in self.states] if keep_states else [])
+
+    def release(self):
+        self.host = None
+
+    def serialize(self, layer, keep_states):
+        i = self.index[id(layer)]
+        rows = slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+        serial_dict = {'params': self.host[0][rows].reshape(layer.weight_shape)}
+        if keep_states:
+            if len(self.host) > 1:
+                serial_dict['states'] = [s[rows].reshape(layer.weight_shape)
+                                         for s in self.host[1:]]
+            else:
+                serial_dict['states'] = [s.get() for s in layer.states]
+        return serial_dict
+
 
 class TaxonomicAffine(list):
     # Uses tax linear and tax bias layers which accumulate dW
@@ -279,7 +964,18 @@ class TaxonomicAffine(list):
             self.append(Activation(transform=activation, name=act_name))
 
 
-class TaxonomicLinear(Linear):
+class ArenaParams(object):
+
+    # Set by ParamArena when W, dW and states are views into it
+    arena = None
+
+    def get_params_serialize(self, keep_states=True):
+        if self.arena is not None and self.arena.host is not None:
+            return self.arena.serialize(self, keep_states)
+        return super(ArenaParams, self).get_params_serialize(keep_states)
+
+
+class TaxonomicLinear(ArenaParams, Linear):
 
     # Only difference to Linear is that we must accumulate gradient in dW so set beta = 1.0
     def bprop(self, error, alpha=1.0, beta=0.0):
@@ -289,13 +985,12 @@ class TaxonomicLinear(Linear):
         self.be.compound_dot(A=error, B=self.inputs.T, C=self.dW, beta=1.0)
         return self.deltas
 
-class TaxonomicBias(Bias):
+class TaxonomicBias(ArenaParams, Bias):
 
     # Must accumulate gradient in dW
     def bprop(self, error):
         if self.deltas is None:
             self.deltas = error.reshape(self.y.shape)
-        self.dW[:] = self.dW + self.deltas
-        #self.be.sum(self.deltas, axis=1, out=self.dW)
+        self.dW[:] = self.dW + self.be.sum(self.deltas, axis=1)
         return error
 
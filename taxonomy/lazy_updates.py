@@ -0,0 +1,148 @@
+"""
+Optimizer paths for the tree of classifiers. LazyNodeOptimizer only updates the few node
+classifiers a minibatch reaches. The updates the other nodes skip, in which momentum and weight
+decay alone move their parameters, are applied in closed form before the node is next updated
+and at the end of every epoch. ArenaOptimizer updates all node classifiers kept in parameter
+arenas with one bulk update per arena.
+"""
+from collections import defaultdict
+
+import numpy as np
+
+from neon import NervanaObject
+from neon.optimizers import GradientDescentMomentum, MultiOptimizer
+
+
+def layer_optimizer(optimizer, layer):
+    """ Optimizer which updates layer, looked up by name then class like MultiOptimizer does """
+    if not isinstance(optimizer, MultiOptimizer):
+        return optimizer
+    mapping = optimizer.optimizer_mapping
+    for key in (layer.name, layer.__class__.__name__):
+        if key in mapping:
+            return mapping[key]
+    return mapping['default']
+
+
+def skipped_steps(opt, lrate, nsteps):
+    """
+    2x2 matrix advancing (param, velocity) through nsteps updates of GradientDescentMomentum
+    with zero gradients:  v' = momentum * v - lrate * wdecay * p,  p' = p + v'
+    """
+    a = lrate * opt.wdecay
+    step = np.array([[1. - a, opt.momentum_coef], [-a, opt.momentum_coef]])
+    return np.linalg.matrix_power(step, nsteps)
+
+
+class LazyNodeOptimizer(NervanaObject):
+
+    """
+    Updates the layers of the node classifiers a minibatch reached, as listed in the branch's
+    touched attribute, and every other layer of the model each step. Node layers updated by
+    other optimizers than GradientDescentMomentum have no closed form catch up and are updated
+    every step too. The parameters match those of updating every layer every step only once
+    finish_epoch has run, i.e. at the end of the epoch. In between, e.g. for on_minibatch_end
+    callbacks, the nodes lag behind by the updates they skipped since they were last reached.
+
+    Arguments:
+        optimizer (Optimizer): Optimizer of the model, may be a MultiOptimizer
+        layers (list): Layers of the model to optimize
+        branch (TaxonomicBranch): Tree of classifiers whose nodes are updated lazily
+    """
+
+    def __init__(self, optimizer, layers, branch):
+        self.branch = branch
+        node_of = {}
+        for k, lst in branch.layers.items():
+            for l in lst:
+                node_of[id(l)] = k
+        self.nodes = defaultdict(list)  # internal id : [(layer, optimizer)]
+        self.dense = defaultdict(list)  # optimizer : layers updated every step
+        for l in layers:
+            opt = layer_optimizer(optimizer, l)
+            if id(l) in node_of and isinstance(opt, GradientDescentMomentum):
+                self.nodes[node_of[id(l)]].append((l, opt))
+            else:
+                self.dense[opt].append(l)
+        self.step = 0
+        # Step up to which each node's updates have been applied
+        self.last = dict.fromkeys(self.nodes, 0)
+        self.scratch = {}
+
+    def optimize(self, epoch):
+        self.step += 1
+        groups = defaultdict(list)
+        for opt, layers in self.dense.items():
+            groups[opt].extend(layers)
+        for k in self.branch.touched:
+            if k in self.nodes:
+                self._catch_up(k, self.step - 1, epoch)
+                for l, opt in self.nodes[k]:
+                    groups[opt].append(l)
+                self.last[k] = self.step
+        for opt, layers in groups.items():
+            opt.optimize(layers, epoch=epoch)
+
+    def finish_epoch(self, epoch):
+        """ Applies every skipped update, before the learning rate can change """
+        for k in self.nodes:
+            self._catch_up(k, self.step, epoch)
+
+    def _catch_up(self, k, step, epoch):
+        nsteps = step - self.last[k]
+        self.last[k] = step
+        if nsteps == 0:
+            return
+        for l, opt in self.nodes[k]:
+            m = skipped_steps(opt, opt.schedule.get_learning_rate(opt.learning_rate, epoch),
+                              nsteps)
+            (param, grad), states = l.get_params()
+            if opt.momentum_coef == 0:
+                param[:] = param * float(m[0, 0])
+                continue
+            # The optimizer creates the velocity on a layer's first update
+            if len(states) == 0:
+                states.append(self.be.zeros_like(grad))
+            velocity = states[0]
+            if param.shape not in self.scratch:
+                self.scratch[param.shape] = self.be.empty(param.shape)
+            tmp = self.scratch[param.shape]
+            tmp[:] = float(m[0, 0]) * param + float(m[0, 1]) * velocity
+            velocity[:] = float(m[1, 0]) * param + float(m[1, 1]) * velocity
+            param[:] = tmp
+
+
+class ArenaOptimizer(object):
+
+    """
+    Updates the parameter arenas of a tree of classifiers as single layers, and every other
+    layer of the model through the model's optimizer. An arena is updated in bulk when its
+    layers share one GradientDescentMomentum, whose velocity it then shares out to the layers.
+    Otherwise its layers are updated one by one.
+
+    Arguments:
+        optimizer (Optimizer): Optimizer of the model, may be a MultiOptimizer
+        layers (list): Layers of the model to optimize
+        branch (TaxonomicBranch): Tree of classifiers allocated with arena=True
+    """
+
+    def __init__(self, optimizer, layers, branch):
+        self.optimizer = optimizer
+        in_arena = set(id(l) for a in branch.arenas for l in a.layers)
+        self.dense = [l for l in layers if id(l) not in in_arena]
+        self.arenas = []
+        for a in branch.arenas:
+            opts = set(layer_optimizer(optimizer, l) for l in a.layers)
+            opt = opts.pop()
+            if len(opts) == 0 and isinstance(opt, GradientDescentMomentum):
+                if opt.momentum_coef != 0:
+                    a.share_velocity()
+                self.arenas.append((opt, a))
+            else:
+                self.dense.extend(a.layers)
+
+    def optimize(self, epoch):
+        # The same dense list every step, as MultiOptimizer maps its layers only once
+        self.optimizer.optimize(self.dense, epoch=epoch)
+        for opt, a in self.arenas:
+            opt.optimize([a], epoch=epoch)
@@ -8,6 +8,11 @@ from neon.layers import Sequential, Activation, Tree
 from neon.models.model import Model
 import numpy as np
 
+from layer import DepthTopK, TaxonomicBranch
+from lazy_updates import ArenaOptimizer, LazyNodeOptimizer
+from pipeline import host_metric, MetricWorker
+from profiler import NULL_PROFILER
+
 logger = logging.getLogger(__name__)
 
 class TaxonomicBranchModel(Model):
@@ -22,8 +27,42 @@ class TaxonomicBranchModel(Model):
                                for updating model parameters (ie DescentMomentum, AdaDelta)
     """
 
+    # Replaced by attach_profiler
+    profiler = NULL_PROFILER
+
+    # Set to only update the tree node classifiers each minibatch reaches, see LazyNodeOptimizer.
+    # Their parameters are then only exact at the end of each epoch.
+    lazy_updates = False
+
     def __init__(self, layers=[], name="model", optimizer=None):
         super(TaxonomicBranchModel, self).__init__(layers, name, optimizer)
+        self.node_optimizer = None
+
+    def _node_optimizer(self):
+        """ Optimizer path replacing self.optimizer.optimize for the tree of classifiers, if any """
+        if self.node_optimizer is None:
+            branches = [l for l in self.layers.layers if isinstance(l, TaxonomicBranch)]
+            if self.lazy_updates and not branches:
+                raise NotImplementedError("lazy updates need a TaxonomicBranch head, the fused "
+                                          "head updates all its nodes as one layer")
+            if self.lazy_updates:
+                self.node_optimizer = LazyNodeOptimizer(self.optimizer, self.layers_to_optimize,
+                                                        branches[0])
+            elif branches and branches[0].arenas:
+                self.node_optimizer = ArenaOptimizer(self.optimizer, self.layers_to_optimize,
+                                                     branches[0])
+        return self.node_optimizer
+
+    def serialize(self, *args, **kwargs):
+        # Parameters kept in arenas are copied to the host in one transfer per arena
+        arenas = [a for l in self.layers.layers for a in getattr(l, 'arenas', None) or []]
+        for a in arenas:
+            a.fetch(keep_states=True)
+        try:
+            return super(TaxonomicBranchModel, self).serialize(*args, **kwargs)
+        finally:
+            for a in arenas:
+                a.release()
 
     def _epoch_fit(self, dataset, callbacks):
         """
@@ -35,51 +74,98 @@ class TaxonomicBranchModel(Model):
         #self.cost = CostContainer(None)
         epoch = self.epoch_index
         self.total_cost[:] = 0
+        prof = self.profiler
+        node_opt = self._node_optimizer()
         # iterate through minibatches of the dataset
-        for mb_idx, (x, t) in enumerate(dataset):
+        for mb_idx, (x, t) in enumerate(prof.iterate('data', dataset)):
 
             callbacks.on_minibatch_begin(epoch, mb_idx)
 
-            cost = self.fprop(x)
+            with prof.phase('fprop'):
+                cost = self.fprop(x)
             # To allow for cost call backs to work
             self.cost.cost = cost
             self.total_cost[:] = self.total_cost + cost
 
-            self.bprop(None)
+            with prof.phase('bprop'):
+                self.bprop(None)
 
-            self.optimizer.optimize(self.layers_to_optimize, epoch=epoch)
+            with prof.phase('optimize'):
+                if node_opt is not None:
+                    node_opt.optimize(epoch)
+                else:
+                    self.optimizer.optimize(self.layers_to_optimize, epoch=epoch)
 
             callbacks.on_minibatch_end(epoch, mb_idx)
 
+        if hasattr(node_opt, 'finish_epoch'):
+            with prof.phase('optimize'):
+                node_opt.finish_epoch(epoch)
+
         # now we divide total cost by the number of batches,
         # so it was never total cost, but sum of averages
         # across all the minibatches we trained on
         self.total_cost[:] = self.total_cost / dataset.nbatches
 
-    def eval(self, dataset, metric):
+    # Minibatches evaluated per call of eval, None for the whole dataset. Set it to shorten the
+    # evaluation callbacks of long epochs.
+    eval_max_batches = None
+
+    def eval(self, dataset, metric, max_batches=None):
         """
-        Evaluates a model on a dataset according to an input metric.
+        Evaluates a model on a dataset according to an input metric. The metric is computed
+        on the host in a background thread while the device runs the next minibatch, when
+        pipeline.host_metric supports it.
 
         Arguments:
             datasets (iterable): dataset to evaluate on.
             metric (Cost): what function to evaluate dataset on.
+            max_batches (int, optional): Stop after this many minibatches. Defaults to
+                                         eval_max_batches.
         """
-        self.initialize(dataset)
+        if not self.initialized:
+            self.initialize(dataset)
+        if max_batches is None:
+            max_batches = self.eval_max_batches
+        func = host_metric(metric)
+        worker = MetricWorker(func, len(metric.metric_names)) if func is not None else None
         running_error = np.zeros((len(metric.metric_names)), dtype=np.float32)
         nprocessed = 0
         dataset.reset()
-        for x, t in dataset:
-            if metric.name == 'root_misclass':
-                for l in self.layers.layers[:-1]:
-                    x = l.fprop(x, inference=True)
-                x, t = self.layers.layers[-1].get_root_preds(x, t)
-            else:
-                x = self.fprop(x, inference=True)
-
-            # This logic is for handling partial batch sizes at the end of the dataset
-            bsz = min(dataset.ndata - nprocessed, self.be.bsz)
-            running_error += metric(x, t, calcrange=slice(0, bsz)) * bsz
-            nprocessed += bsz
+        try:
+            for mb_idx, (x, t) in enumerate(dataset):
+                if max_batches is not None and mb_idx >= max_batches:
+                    break
+                if isinstance(metric, DepthTopK):
+                    # Every depth is scored from one pass of the trunk and the head
+                    for l in self.layers.layers[:-1]:
+                        x = l.fprop(x, inference=True)
+                    x = self.layers.layers[-1].node_probs(x)
+                elif metric.name == 'root_misclass':
+                    for l in self.layers.layers[:-1]:
+                        x = l.fprop(x, inference=True)
+                    x, t = self.layers.layers[-1].get_root_preds(x, t)
+                else:
+                    x = self.fprop(x, inference=True)
+
+                # This logic is for handling partial batch sizes at the end of the dataset
+                bsz = min(dataset.ndata - nprocessed, self.be.bsz)
+                if worker is not None:
+                    worker.put(x.get()[:, :bsz], t.get()[:, :bsz])
+                else:
+                    running_error += metric(x, t, calcrange=slice(0, bsz)) * bsz
+                nprocessed += bsz
+        except:
+            # The worker's own error, if any, must not replace the one which ended the loop
+            if worker is not None:
+                worker.stop()
+            raise
+        if worker is not None:
+            running_error += worker.finish()
+        if nprocessed == 0:
+            logger.warning("No minibatches evaluated, the metrics are undefined")
+            running_error[:] = np.nan
+            return running_error
         running_error /= nprocessed
         return running_error
 
@@ -12,7 +12,7 @@ from neon.models import Model
 from neon.data import ImageLoader
 from neon.callbacks.callbacks import Callbacks
 
-from layer import TaxonomicBranch, TaxonomicAffine, FreezeSequential
+from layer import TaxonomicBranch, TaxonomicAffine, TaxonomicFusedHead, FreezeSequential
 from class_taxonomy import ClassTaxonomy
 from model_branch import TaxonomicBranchModel
 
@@ -67,7 +67,8 @@ def create_vgg_layers(nclass):
     layers.append(Affine(nout=nclass, init=init1, bias=Constant(0), activation=Softmax()))
     return layers
 
-def create_branched(layer_func, ctree, img_loader):
+def create_branched(layer_func, ctree, img_loader, grouped=False, inference_mode='greedy',
+                    beam_width=5, arena=False):
     # Replace last layer with Branch Layer
     layers = layer_func(img_loader.nclass)[:-1]
     #assert isinstance(layers[-1], Dropout)
@@ -79,10 +80,19 @@ def create_branched(layer_func, ctree, img_loader):
     cost_container = {k: GeneralizedCost(costfunc=CrossEntropyMulti())
                          for k in ctree.internalid_to_childrenid.keys()}
 
-    branch = TaxonomicBranch(layer_container, cost_container, ctree, img_loader)
+    branch = TaxonomicBranch(layer_container, cost_container, ctree, img_loader, grouped=grouped,
+                             inference_mode=inference_mode, beam_width=beam_width, arena=arena)
     layers.append(branch)
     return layers
 
+def create_fused(layer_func, ctree, img_loader, inference_mode='greedy', beam_width=5):
+    # Replace last layer with a single head holding every internal node's classifier
+    layers = layer_func(img_loader.nclass)[:-1]
+    layers.append(TaxonomicFusedHead(ctree, img_loader, init=Gaussian(scale=0.01),
+                                     bias=Constant(-7), inference_mode=inference_mode,
+                                     beam_width=beam_width))
+    return layers
+
 def create_alexnet_opt():
     # drop weights LR by 1/250**(1/3) at epochs (23, 45, 66), drop bias LR by 1/10 at epoch 45
     weight_sched = Schedule([22, 44, 65], (1/250.)**(1/3.))
@@ -100,7 +110,8 @@ def create_vgg_opt():
     opt = MultiOptimizer({'default': opt_gdm, 'Bias': opt_biases})
     return opt
 
-def create_model(model_type, model_tree, freeze, dataset_dir, model_file, img_loader):
+def create_model(model_type, model_tree, freeze, dataset_dir, model_file, img_loader,
+                 grouped=False, fused=False, inference_mode='greedy', beam_width=5, arena=False):
     cost = GeneralizedCost(costfunc=CrossEntropyMulti())
 
     if model_type == 'alexnet':
@@ -114,7 +125,13 @@ def create_model(model_type, model_tree, freeze, dataset_dir, model_file, img_lo
 
     if model_tree:
         ctree = ClassTaxonomy('Aves', 'taxonomy_dict.p', dataset_dir)
-        layers = created_branched(layer_func, ctree, img_loader)
+        if fused:
+            layers = create_fused(layer_func, ctree, img_loader, inference_mode=inference_mode,
+                                  beam_width=beam_width)
+        else:
+            layers = create_branched(layer_func, ctree, img_loader, grouped=grouped,
+                                     inference_mode=inference_mode, beam_width=beam_width,
+                                     arena=arena)
         model = TaxonomicBranchModel(layers=layers)
     else:
         layers = layer_func(img_loader.nclass)
@@ -0,0 +1,135 @@
+"""
+Background work for the training and evaluation loops: prefetching host data ahead of the
+device, and computing evaluation metrics on the host while the device runs the next minibatch.
+"""
+from Queue import Queue, Full
+import sys
+import threading
+
+import numpy as np
+
+from neon.transforms import Accuracy, Misclassification, TopKMisclassification
+
+from layer import DepthTopK
+
+
+def prefetch(iterable, depth=2):
+    """
+    Iterates over iterable in a background thread, keeping up to depth items ready ahead of
+    the consumer. The items must not share buffers with each other, e.g. host arrays, and the
+    producer must not touch the backend.
+    """
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception:
+            put((False, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            more, item = queue.get()
+            if not more:
+                if item is not None:
+                    raise item[0], item[1], item[2]
+                return
+            yield item
+    finally:
+        # Lets the producer exit when the consumer stops early
+        stop.set()
+
+
+def _topk_misclass(y, t, k):
+    # Same as neon's TopKMisclassification, ties share the remaining slots
+    correct = (y * t).sum(axis=0)
+    nslots = k - (y > correct).sum(axis=0)
+    neq = (y == correct).sum(axis=0).astype(np.float32)
+    topk = 1. - (nslots > 0) * ((neq <= nslots) * (1 - nslots / neq) + nslots / neq)
+    top1 = 1. - (y.max(axis=0) == correct) / neq
+    logloss = -np.log(np.maximum(correct, np.exp(-50.)))
+    return np.vstack([logloss, top1, topk])
+
+
+def _misclass(y, t):
+    return (y.argmax(axis=0) != t.argmax(axis=0))[np.newaxis].astype(np.float32)
+
+
+def host_metric(metric):
+    """
+    Host implementation of a neon metric, mapping outputs and targets of shape
+    (nclass, samples) to per sample values of shape (len(metric.metric_names), samples).
+    None for metrics without one, which are computed on the device instead.
+    """
+    if isinstance(metric, DepthTopK):
+        return metric
+    if isinstance(metric, TopKMisclassification):
+        return lambda y, t: _topk_misclass(y, t, metric.k)
+    if isinstance(metric, Misclassification):
+        return _misclass
+    if isinstance(metric, Accuracy):
+        return lambda y, t: 1. - _misclass(y, t)
+    return None
+
+
+class MetricWorker(threading.Thread):
+
+    """
+    Sums a host metric over the minibatches handed to it with put, in a background thread.
+
+    Arguments:
+        func (callable): Host metric, as returned by host_metric
+        nmetrics (int): Number of values func returns per sample
+        depth (int, optional): Minibatches which may wait for the worker before put blocks
+    """
+
+    def __init__(self, func, nmetrics, depth=4):
+        super(MetricWorker, self).__init__()
+        self.daemon = True
+        self.func = func
+        self.queue = Queue(maxsize=depth)
+        self.totals = np.zeros(nmetrics, dtype=np.float64)
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.totals += self.func(*item).sum(axis=1)
+                except Exception:
+                    self.error = sys.exc_info()
+
+    def put(self, y, t):
+        self.queue.put((y, t))
+
+    def stop(self):
+        """ Lets the thread exit once the queued minibatches are done, discarding the results """
+        self.queue.put(None)
+
+    def finish(self):
+        """ Waits for the queued minibatches and returns the metric sums """
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.totals
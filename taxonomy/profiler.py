@@ -0,0 +1,218 @@
+"""
+Opt-in profiling of the taxonomic models: wall time per training phase, samples and time per
+internal node classifier, the number of host <-> device transfers and of device buffers
+allocated while training.
+"""
+from collections import OrderedDict
+import time
+
+import numpy as np
+
+from neon.callbacks.callbacks import Callback
+
+
+class _Timer(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        # Register the phase on entry so phases are listed outermost first
+        self.profiler.phases.setdefault(self.name, [0., 0])
+        self.start = self.profiler.clock()
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.name, self.profiler.clock() - self.start)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+NULL_TIMER = _NullTimer()
+
+# Backend methods which allocate a device buffer
+ALLOCATORS = ('empty', 'zeros', 'ones', 'array', 'iobuf', 'empty_like', 'zeros_like')
+
+
+class Profiler(object):
+
+    """
+    Accumulates the counters of one epoch. Phases are named like 'fprop/head' for a part of
+    'fprop'. A disabled profiler hands out a shared no-op timer and ignores every counter, so
+    instrumented code only pays for a method call.
+
+    Arguments:
+        enabled (bool, optional): Whether to record anything. Defaults to True.
+        sync (callable, optional): Called before reading the clock, e.g. to wait for queued
+            device kernels so their time is not charged to the next host transfer.
+    """
+
+    def __init__(self, enabled=True, sync=None):
+        self.enabled = enabled
+        self.sync = sync
+        self.reset()
+
+    def reset(self):
+        self.phases = OrderedDict()  # name : [seconds, calls]
+        self.nodes = {}  # internal node : [samples, fprop seconds, bprop seconds]
+        self.transfers = 0
+        self.allocations = 0
+
+    def clock(self):
+        if self.sync is not None:
+            self.sync()
+        return time.time()
+
+    def phase(self, name):
+        return _Timer(self, name) if self.enabled else NULL_TIMER
+
+    def add_time(self, name, seconds, calls=1):
+        acc = self.phases.setdefault(name, [0., 0])
+        acc[0] += seconds
+        acc[1] += calls
+
+    def iterate(self, name, iterable):
+        """ Charges the time spent fetching each item of iterable to phase name """
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iterable)
+
+    def _iterate(self, name, iterable):
+        it = iter(iterable)
+        while True:
+            start = self.clock()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.add_time(name, self.clock() - start)
+            yield item
+
+    def node(self, node, samples=0, fprop=0., bprop=0.):
+        if self.enabled:
+            acc = self.nodes.setdefault(node, [0, 0., 0.])
+            acc[0] += samples
+            acc[1] += fprop
+            acc[2] += bprop
+
+    def transfer(self, count=1):
+        if self.enabled:
+            self.transfers += count
+
+    def watch_allocations(self, be):
+        """
+        Wraps the allocating methods of the backend instance so the buffers it allocates while
+        the profiler is enabled are counted. Allocations made inside another, e.g. the zeros
+        of an iobuf, count once.
+        """
+        if getattr(be, 'allocation_profiler', None) is self:
+            return
+        be.allocation_profiler = self
+        depth = [0]
+
+        def counted(func):
+            def alloc(*args, **kwargs):
+                if depth[0] == 0 and self.enabled:
+                    self.allocations += 1
+                depth[0] += 1
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    depth[0] -= 1
+            return alloc
+
+        for name in ALLOCATORS:
+            if hasattr(be, name):
+                setattr(be, name, counted(getattr(be, name)))
+
+    def summary(self, max_nodes=10):
+        lines = ['%-24s %10s %8s %10s' % ('phase', 'total s', 'calls', 'ms/call')]
+        for name, (seconds, calls) in self.phases.items():
+            indent = '  ' * name.count('/')
+            lines.append('%-24s %10.3f %8d %10.3f' % (indent + name.split('/')[-1], seconds,
+                                                      calls, 1e3 * seconds / max(calls, 1)))
+        lines.append('host <-> device transfers: %d' % self.transfers)
+        lines.append('device allocations: %d' % self.allocations)
+        if len(self.nodes) > 0:
+            lines.append('%-24s %10s %10s %10s' % ('node', 'samples', 'fprop s', 'bprop s'))
+            busiest = sorted(self.nodes.items(), key=lambda kv: -(kv[1][1] + kv[1][2]))
+            for node, (samples, fprop, bprop) in busiest[:max_nodes]:
+                lines.append('%-24s %10d %10.3f %10.3f' % (node[:24], samples, fprop, bprop))
+        return '\n'.join(lines)
+
+NULL_PROFILER = Profiler(enabled=False)
+
+
+def attach_profiler(model, profiler):
+    """
+    Points the model and every layer of it which supports profiling at profiler, and counts
+    the allocations of the backend
+    """
+    model.profiler = profiler
+    profiler.watch_allocations(model.be)
+    for l in model.layers.layers:
+        if hasattr(l, 'profiler'):
+            l.profiler = profiler
+
+
+class ProfilerCallback(Callback):
+
+    """
+    Resets the profiler at the start of every epoch, and at its end writes the counters to
+    the callback data under profile/ (phase/<name> seconds with '/' in names written as '.',
+    transfers, allocations made by the training minibatches, which is zero in steady state,
+    and node/samples, node/fprop_time and node/bprop_time per internal node listed in the
+    node/names attribute) and prints a summary table.
+
+    Arguments:
+        profiler (Profiler): Profiler attached to the model with attach_profiler
+        nodes (list, optional): Internal node names to record, e.g. from the ClassTaxonomy.
+            Defaults to no per node datasets.
+        epoch_freq (int, optional): Epochs between summaries. Defaults to 1.
+    """
+
+    def __init__(self, profiler, nodes=None, epoch_freq=1):
+        super(ProfilerCallback, self).__init__(epoch_freq=epoch_freq)
+        self.profiler = profiler
+        self.node_names = list(nodes or [])
+
+    def on_train_begin(self, callback_data, model, epochs):
+        self.epochs = epochs
+        callback_data.create_dataset('profile/transfers', (epochs,))
+        callback_data.create_dataset('profile/allocations', (epochs,))
+        if len(self.node_names) > 0:
+            for key in ('samples', 'fprop_time', 'bprop_time'):
+                callback_data.create_dataset('profile/node/' + key,
+                                             (epochs, len(self.node_names)))
+            callback_data['profile/node'].attrs['names'] = np.array(self.node_names, dtype='S')
+
+    def on_epoch_begin(self, callback_data, model, epoch):
+        self.profiler.reset()
+        self.train_allocations = 0
+
+    def on_minibatch_end(self, callback_data, model, epoch, minibatch):
+        # Leaves out what the evaluation callbacks allocate at the end of the epoch
+        self.train_allocations = self.profiler.allocations
+
+    def on_epoch_end(self, callback_data, model, epoch):
+        prof = self.profiler
+        for name, (seconds, calls) in prof.phases.items():
+            # 'fprop' is a dataset, so 'fprop/head' can not be a path below it
+            key = 'profile/phase/' + name.replace('/', '.')
+            if key not in callback_data:
+                callback_data.create_dataset(key, (self.epochs,))
+            callback_data[key][epoch] = seconds
+        callback_data['profile/transfers'][epoch] = prof.transfers
+        callback_data['profile/allocations'][epoch] = self.train_allocations
+        if len(self.node_names) > 0:
+            counters = np.array([prof.nodes.get(n, [0, 0., 0.]) for n in self.node_names])
+            for k, key in enumerate(('samples', 'fprop_time', 'bprop_time')):
+                callback_data['profile/node/' + key][epoch] = counters[:, k]
+        if (epoch + 1) % self.epoch_freq == 0:
+            print('Profile of epoch %d\n%s' % (epoch, prof.summary()))
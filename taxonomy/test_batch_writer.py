@@ -0,0 +1,61 @@
+"""
+Tests of the macrobatch writers. Run with: py.test taxonomy
+"""
+import struct
+
+import numpy as np
+
+from batch_writer import BirdsBatchWriter
+
+
+def reference_write_binary(jpegs, labels, ofname):
+    """ write_binary as it was before the buffer writes, packing every byte with struct """
+    num_imgs = len(jpegs)
+    keylist = ['l_id']
+    with open(ofname, 'wb') as f:
+        f.write(struct.pack('I', num_imgs))
+        f.write(struct.pack('I', len(keylist)))
+
+        for key in keylist:
+            ksz = len(key)
+            f.write(struct.pack('L' + 'B' * ksz, ksz, *bytearray(key)))
+            f.write(struct.pack('I' * num_imgs, *labels[key]))
+
+        for i in range(num_imgs):
+            jsz = len(jpegs[i])
+            bin = struct.pack('I' + 'B' * jsz, jsz, *bytearray(jpegs[i]))
+            f.write(bin)
+
+
+def random_records(rng, num_imgs):
+    jpegs = [rng.randint(256, size=rng.randint(1, 5000)).astype(np.uint8).tostring()
+             for _ in range(num_imgs)]
+    # An empty record, and a uint8 array as proc_img returns for images already at size
+    jpegs[1] = b''
+    jpegs[2] = rng.randint(256, size=3000).astype(np.uint8)
+    labels = {'l_id': [int(l) for l in rng.randint(555, size=num_imgs)]}
+    return jpegs, labels
+
+
+def test_write_binary_matches_struct_pack(tmpdir):
+    jpegs, labels = random_records(np.random.RandomState(0), 50)
+    writer = BirdsBatchWriter.__new__(BirdsBatchWriter)
+    ref_file, out_file = str(tmpdir.join('ref.bin')), str(tmpdir.join('out.bin'))
+    reference_write_binary(jpegs, labels, ref_file)
+    offsets = writer.write_binary(jpegs, labels, out_file)
+
+    data = open(out_file, 'rb').read()
+    assert data == open(ref_file, 'rb').read()
+    for jpeg, (offset, length) in zip(jpegs, offsets):
+        jpeg = jpeg.tostring() if isinstance(jpeg, np.ndarray) else jpeg
+        assert data[offset:offset + length] == jpeg
+
+
+def test_write_binary_from_generator(tmpdir):
+    # Records may arrive from an iterator, e.g. straight from the resize pool
+    jpegs, labels = random_records(np.random.RandomState(1), 10)
+    writer = BirdsBatchWriter.__new__(BirdsBatchWriter)
+    ref_file, out_file = str(tmpdir.join('ref.bin')), str(tmpdir.join('out.bin'))
+    reference_write_binary(jpegs, labels, ref_file)
+    writer.write_binary(iter(jpegs), labels, out_file)
+    assert open(out_file, 'rb').read() == open(ref_file, 'rb').read()
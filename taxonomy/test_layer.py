@@ -0,0 +1,295 @@
+"""
+Tests of the tree heads and the search over the class taxonomy. Run with: py.test taxonomy
+"""
+import os
+
+import numpy as np
+import pytest
+
+from neon.backends import gen_backend
+from neon.initializers import Constant, Gaussian
+from neon.layers import Dropout, GeneralizedCost
+from neon.optimizers import GradientDescentMomentum
+from neon.transforms import CrossEntropyMulti, Softmax
+
+from benchmark import write_classes, write_features
+from class_taxonomy import ClassTaxonomy
+from feature_cache import FeatureLoader
+from lazy_updates import ArenaOptimizer
+from layer import beam_search, child_rows, path_matrices, DepthTopK, TaxonomicAffine, \
+    TaxonomicBranch, TaxonomicFusedHead
+from model_branch import TaxonomicBranchModel
+from profiler import Profiler
+
+ADJ_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taxonomy_dict.p')
+
+
+def reference_fprop(branch, inputs, labels):
+    """
+    The per sample training pass as it was before the column views and bulk targets: every
+    column is copied into its own buffer and the one hot targets of every node are built
+    afresh. Returns the cost, the deltas and the dW of every node layer, on the host.
+    """
+    be = branch.be
+    for l in branch.layers_to_optimize:
+        l.dW[:] = 0
+    col = be.empty((branch.nin, 1))
+    total_cost = 0.
+    deltas = np.zeros(inputs.shape, dtype=np.float32)
+    for i, label in enumerate(labels):
+        col[:] = inputs[:, i]
+        leaf = branch.ctree.labelidx_to_leafid[label]
+        for internalid, lbl in branch.ctree.leafid_to_internallabels[leaf][:branch.train_depth]:
+            targets = be.zeros((len(branch.ctree.internalid_to_childrenid[internalid]), 1))
+            targets[lbl] = 1
+            x = branch._do_fprop(branch.layers[internalid], col)
+            total_cost += branch.costs[internalid].get_cost(x, targets).get()[0, 0]
+            delta = branch.costs[internalid].get_errors(x, targets)
+            deltas[:, i:i + 1] += branch._do_bprop(branch.layers[internalid], delta).get()
+    return total_cost / be.bsz, deltas, node_grads(branch)
+
+
+def reference_descent(branch, inputs):
+    """
+    The greedy descent as the per sample branch did it before _descend: every column is run
+    down the tree on its own. Returns the leaf id reached by each data point.
+    """
+    col = branch.be.empty((branch.nin, 1))
+    leaves = []
+    for i in range(branch.be.bsz):
+        col[:] = inputs[:, i]
+        curr_id = branch.ctree.root
+        while curr_id in branch.ctree.internalid_to_childrenid:
+            x = branch._do_fprop(branch.layers[curr_id], col).get()
+            curr_id = branch.ctree.internalid_to_childrenid[curr_id][x.argmax()]
+        leaves.append(curr_id)
+    return leaves
+
+
+def node_grads(branch):
+    return {(k, j): l.dW.get() for k, v in branch.layers.items()
+            for j, l in enumerate(v) if l.has_params}
+
+
+def make_branch(ctree, loader, grouped, arena=False):
+    layers = {k: TaxonomicAffine(nout=len(v), init=Gaussian(scale=0.5), bias=Constant(0.1),
+                                 activation=Softmax())
+              for k, v in ctree.internalid_to_childrenid.items()}
+    costs = {k: GeneralizedCost(costfunc=CrossEntropyMulti()) for k in layers}
+    branch = TaxonomicBranch(layers, costs, ctree, loader, grouped=grouped, arena=arena)
+    model = TaxonomicBranchModel(layers=[Dropout(keep=1.0), branch])
+    model.initialize(loader)
+    return branch
+
+
+def share_params(src, dst):
+    for k in src.layers:
+        for l, ld in zip(src.layers[k], dst.layers[k]):
+            if l.has_params:
+                ld.W[:] = l.W
+
+
+@pytest.fixture
+def ctree(tmpdir):
+    write_classes(ADJ_FILE, str(tmpdir))
+    return ClassTaxonomy('Aves', ADJ_FILE, str(tmpdir), cache_dir=False)
+
+
+@pytest.fixture
+def data(tmpdir, ctree):
+    be = gen_backend(backend='cpu', batch_size=8, rng_seed=0)
+    prefix = str(tmpdir.join('features'))
+    write_features(prefix, 3 * be.bsz, 16, len(ctree.labelidx_to_leafid))
+    return ctree, FeatureLoader(prefix)
+
+
+def random_log_probs(ctree, bsz, rng):
+    """ (nrows, bsz) log probs of the stacked node outputs, normalized within each node """
+    logits = rng.randn(len(ctree.node_ids) - 1, bsz)
+    probs = np.exp(logits)
+    for n in np.where(ctree.child_offset >= 0)[0]:
+        rows = slice(ctree.child_offset[n] - 1, ctree.child_offset[n] - 1 + ctree.child_count[n])
+        probs[rows] /= probs[rows].sum(axis=0)
+    return np.log(probs)
+
+
+def test_beam_wider_than_the_leaves(ctree):
+    nclass = len(ctree.labelidx_to_leafid)
+    log_probs = random_log_probs(ctree, 4, np.random.RandomState(0))
+    leaves, scores = beam_search(log_probs, child_rows(ctree), ctree.node_labelidx, nclass + 5)
+
+    # Nothing is pruned, so every leaf is found with its exact path log prob, best first
+    path_targets, _ = path_matrices(ctree)
+    exact = np.dot(path_targets.T, log_probs)
+    reachable = path_targets.sum(axis=0) > 0
+    nfound = reachable.sum()
+    assert np.isfinite(scores[:, :nfound]).all()
+    assert np.isneginf(scores[:, nfound:]).all()
+    assert (leaves[:, nfound:] == -1).all()
+    for i in range(leaves.shape[0]):
+        assert np.allclose(scores[i, :nfound], exact[leaves[i, :nfound], i])
+        assert np.allclose(scores[i, :nfound], np.sort(exact[reachable, i])[::-1])
+
+
+def test_depth_topk_rootless_label(tmpdir):
+    # A class of the dataset which is not in the taxonomy has no path
+    nclass = write_classes(ADJ_FILE, str(tmpdir))
+    with open(str(tmpdir.join('classes.txt')), 'a') as f:
+        f.write('%d Notinthetaxonomy\n' % nclass)
+    ctree = ClassTaxonomy('Aves', ADJ_FILE, str(tmpdir), cache_dir=False)
+    assert ctree.leaf_path_indptr[nclass + 1] == ctree.leaf_path_indptr[nclass]
+
+    # With k above the number of candidates every label with a path is a hit
+    metric = DepthTopK(ctree, ks=(1, nclass + 1))
+    probs = np.exp(random_log_probs(ctree, 4, np.random.RandomState(0)))
+    labels = [nclass, 0, nclass, 1]
+    hits = metric(probs, np.eye(nclass + 1, dtype=np.float32)[:, labels])
+    assert hits.shape == (len(metric.metric_names), 4)
+    assert (hits[:, [0, 2]] == 0).all()
+    assert (hits[1::2][:, [1, 3]] == 1).all()
+
+
+@pytest.mark.parametrize('train_depth', [1, 3])
+def test_fprop_matches_reference(data, train_depth):
+    ctree, loader = data
+    branch = make_branch(ctree, loader, grouped=False)
+    grouped = make_branch(ctree, loader, grouped=True)
+    for b in (branch, grouped):
+        b.train_depth = train_depth
+    # Both branches start from the same parameters
+    share_params(branch, grouped)
+
+    for x, t in loader:
+        labels = loader.labels.get()[0].astype(np.int64)
+        inputs = x.get()
+        ref_cost, ref_deltas, ref_grads = reference_fprop(branch, x, labels)
+
+        for b in (branch, grouped):
+            # The reference left gradients on nodes the last minibatch may not have reached
+            b.touched = None
+            cost = b.fprop(x).get()[0, 0]
+            assert np.allclose(cost, ref_cost, rtol=1e-5, atol=1e-6)
+            assert np.allclose(b.deltas.get(), ref_deltas, rtol=1e-4, atol=1e-6)
+            grads = node_grads(b)
+            for key, ref in ref_grads.items():
+                assert np.allclose(grads[key], ref, rtol=1e-4, atol=1e-6), key
+        # The columns are views, training must not write to the input
+        assert np.array_equal(x.get(), inputs)
+
+
+@pytest.mark.parametrize('train_depth', [1, 3])
+@pytest.mark.parametrize('grouped', [False, True])
+def test_training_allocates_nothing(data, grouped):
+    ctree, loader = data
+    branch = make_branch(ctree, loader, grouped=grouped)
+    branch.train_depth = 3
+    prof = Profiler()
+    prof.watch_allocations(branch.be)
+    branch.profiler = prof
+    for epoch in range(2):
+        for mb, (x, t) in enumerate(loader):
+            # The first minibatch may still set up cached views
+            if epoch == 0 and mb == 1:
+                prof.reset()
+            branch.fprop(x)
+            branch.bprop(None)
+    assert prof.allocations == 0
+
+
+def test_descent_matches_reference(data):
+    ctree, loader = data
+    branch = make_branch(ctree, loader, grouped=False)
+    grouped = make_branch(ctree, loader, grouped=True)
+    share_params(branch, grouped)
+
+    for x, t in loader:
+        ref = reference_descent(branch, x)
+        ref_preds = np.zeros((len(ctree.labelidx_to_leafid), len(ref)))
+        ref_preds[[ctree.leafid_to_labelidx[l] for l in ref], np.arange(len(ref))] = 1
+        for b in (branch, grouped):
+            # The leaf below the last node of each path is the argmax of its output
+            leaves = [ctree.internalid_to_childrenid[path[-1][0]][path[-1][1].argmax()]
+                      for path in b.get_outputs(x)]
+            assert leaves == ref
+            assert np.array_equal(b.fprop(x, inference=True).get(), ref_preds)
+
+
+@pytest.mark.parametrize('train_depth', [1, 3])
+def test_fused_head_matches_branch(data, train_depth):
+    ctree, loader = data
+    branch = make_branch(ctree, loader, grouped=True)
+    head = TaxonomicFusedHead(ctree, loader, init=Gaussian(scale=0.5), bias=Constant(0.1))
+    for b in (branch, head):
+        b.train_depth = train_depth
+    TaxonomicBranchModel(layers=[Dropout(keep=1.0), head]).initialize(loader)
+
+    # The fused parameters are those of the node classifiers, stacked like node_probs
+    linear, bias = head.layers
+    segments = {}
+    for n in np.where(ctree.child_offset >= 0)[0]:
+        rows = slice(ctree.child_offset[n] - 1, ctree.child_offset[n] - 1 + ctree.child_count[n])
+        segments[ctree.node_ids[n]] = rows
+        node = branch.layers[ctree.node_ids[n]]
+        linear.W[rows] = node[0].W
+        bias.W[rows] = node[1].W
+
+    for x, t in loader:
+        # Segmented softmax against a softmax per node classifier
+        assert np.allclose(head.node_probs(x).get(), branch.node_probs(x).get(),
+                           rtol=1e-4, atol=1e-6)
+
+        branch.touched = None
+        ref_cost = branch.fprop(x).get()[0, 0]
+        ref_deltas = branch.bprop(None).get()
+        cost = head.fprop(x).get()[0, 0]
+        deltas = head.bprop(None).get()
+        assert np.allclose(cost, ref_cost, rtol=1e-5, atol=1e-6)
+        assert np.allclose(deltas, ref_deltas, rtol=1e-4, atol=1e-6)
+        for k, rows in segments.items():
+            assert np.allclose(linear.dW.get()[rows], branch.layers[k][0].dW.get(),
+                               rtol=1e-4, atol=1e-6), k
+            assert np.allclose(bias.dW.get()[rows], branch.layers[k][1].dW.get(),
+                               rtol=1e-4, atol=1e-6), k
+
+
+@pytest.mark.parametrize('momentum', [0., 0.9])
+def test_arena_update_matches_layers(data, momentum):
+    ctree, loader = data
+    branch = make_branch(ctree, loader, grouped=True, arena=True)
+    plain = make_branch(ctree, loader, grouped=True)
+    share_params(branch, plain)
+    # create_model initializes a model with frozen layers twice
+    branch.allocate()
+
+    # The layers' parameters and gradients are still views into the arenas
+    for a in branch.arenas:
+        params = [l.W.get() for l in a.layers]
+        a.W[:] = a.W * 2
+        for l, p in zip(a.layers, params):
+            assert np.array_equal(l.W.get(), 2 * p)
+        a.W[:] = a.W / 2
+        a.dW[:] = 1
+        for l in a.layers:
+            assert (l.dW.get() == 1).all()
+            l.dW[:] = 0
+        assert (a.dW.get() == 0).all()
+
+    opt = GradientDescentMomentum(0.1, momentum, wdecay=0.01)
+    arena_opt = ArenaOptimizer(GradientDescentMomentum(0.1, momentum, wdecay=0.01),
+                               branch.layers_to_optimize, branch)
+    pairs = [(l, lp) for k in branch.layers for l, lp in zip(branch.layers[k], plain.layers[k])
+             if l.has_params]
+    rng = np.random.RandomState(0)
+    for step in range(5):
+        for l, lp in pairs:
+            grad = rng.randn(*l.dW.shape)
+            l.dW.set(grad)
+            lp.dW.set(grad)
+        arena_opt.optimize(epoch=0)
+        opt.optimize(plain.layers_to_optimize, epoch=0)
+
+    for l, lp in pairs:
+        assert np.allclose(l.W.get(), lp.W.get(), rtol=1e-5, atol=1e-6)
+        assert len(l.states) == len(lp.states)
+        for s, sp in zip(l.states, lp.states):
+            assert np.allclose(s.get(), sp.get(), rtol=1e-5, atol=1e-6)
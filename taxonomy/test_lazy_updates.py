@@ -0,0 +1,81 @@
+"""
+Tests of the lazy optimizer path of the tree of classifiers. Run with: py.test taxonomy
+"""
+import numpy as np
+import pytest
+
+from neon.backends import gen_backend
+from neon.optimizers import GradientDescentMomentum
+
+from lazy_updates import LazyNodeOptimizer
+
+
+class ParamLayer(object):
+    """ Parameter layer with the interface the optimizers use """
+
+    has_params = True
+
+    def __init__(self, be, name, W):
+        self.name = name
+        self.W = be.array(W)
+        self.dW = be.zeros(W.shape)
+        self.states = []
+
+    def get_params(self):
+        return ((self.W, self.dW), self.states)
+
+
+class Branch(object):
+    """ Stands in for a TaxonomicBranch: node classifiers and the nodes the minibatch reached """
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.touched = None
+
+
+def make_layers(be, rng):
+    nodes = {}
+    for k in ['root', 'a', 'b', 'c']:
+        nodes[k] = [ParamLayer(be, k + '_linear', rng.randn(3, 5)),
+                    ParamLayer(be, k + '_bias', rng.randn(3, 1))]
+    trunk = [ParamLayer(be, 'trunk', rng.randn(5, 5))]
+    return nodes, trunk
+
+
+@pytest.mark.parametrize('momentum', [0., 0.9])
+@pytest.mark.parametrize('wdecay', [0., 0.01])
+def test_lazy_matches_eager(momentum, wdecay):
+    be = gen_backend(backend='cpu', batch_size=4, rng_seed=0)
+    eager_nodes, eager_trunk = make_layers(be, np.random.RandomState(0))
+    lazy_nodes, lazy_trunk = make_layers(be, np.random.RandomState(0))
+    eager_opt = GradientDescentMomentum(0.1, momentum, wdecay=wdecay)
+    lazy_opt = GradientDescentMomentum(0.1, momentum, wdecay=wdecay)
+    eager_layers = eager_trunk + [l for k in sorted(eager_nodes) for l in eager_nodes[k]]
+    lazy_layers = lazy_trunk + [l for k in sorted(lazy_nodes) for l in lazy_nodes[k]]
+    branch = Branch(lazy_nodes)
+    lazy = LazyNodeOptimizer(lazy_opt, lazy_layers, branch)
+
+    rng = np.random.RandomState(1)
+    for epoch in range(2):
+        for step in range(10):
+            # The root every step, each other node now and then, some not for several steps
+            touched = ['root'] + [k for k in ['a', 'b', 'c'] if rng.rand() < 0.3]
+            branch.touched = set(touched)
+            for k in sorted(eager_nodes):
+                for le, ll in zip(eager_nodes[k], lazy_nodes[k]):
+                    grad = rng.randn(*le.dW.shape) if k in touched else np.zeros(le.dW.shape)
+                    le.dW.set(grad)
+                    ll.dW.set(grad)
+            grad = rng.randn(5, 5)
+            eager_trunk[0].dW.set(grad)
+            lazy_trunk[0].dW.set(grad)
+
+            eager_opt.optimize(eager_layers, epoch=epoch)
+            lazy.optimize(epoch)
+        lazy.finish_epoch(epoch)
+
+        for le, ll in zip(eager_layers, lazy_layers):
+            assert np.allclose(le.W.get(), ll.W.get(), rtol=1e-4, atol=1e-5)
+            assert len(le.states) == len(ll.states)
+            for se, sl in zip(le.states, ll.states):
+                assert np.allclose(se.get(), sl.get(), rtol=1e-4, atol=1e-5)
@@ -4,6 +4,7 @@ Example command:
 python train.py -eval 1 --model_type alexnet --freeze 2 -w ~/nervana/data/NABirds_batchs
  -b gpu -i 0 -e 40 --dataset_dir ~/NABirds --model_file alexnet.p -vvvv
 """
+import os
 
 from neon.util.argparser import NeonArgparser
 from neon.initializers import Constant, Gaussian
@@ -14,15 +15,44 @@ from neon.data import ImageLoader
 from neon.callbacks.callbacks import Callbacks
 
 from model_descriptions import create_model
+from layer import DepthTopK
+from feature_cache import extract_features, head_model, FeatureLoader
+from profiler import Profiler, ProfilerCallback, attach_profiler
 
 # parse the command line arguments (generates the backend)
 parser = NeonArgparser(__doc__)
 parser.add_argument('--model_type', help='Name of model', required=True, choices=['alexnet', 'vgg'])
 parser.add_argument('--model_tree', help='Whether or not to train tree of classifiers',
                     default=False, type=bool)
+parser.add_argument('--grouped', help='Whether to train each tree node over its whole minibatch bucket',
+                    default=False, type=bool)
+parser.add_argument('--fused', help='Whether to use a single fused head for the tree of classifiers',
+                    default=False, type=bool)
+parser.add_argument('--inference_mode', help='How the tree of classifiers scores the leaves',
+                    default='greedy', choices=['greedy', 'marginal', 'beam'])
+parser.add_argument('--beam_width', type=int, help='Paths kept by beam inference', default=5)
 parser.add_argument('--freeze', type=int, help='Layers to freeze starting from end', default=0)
 parser.add_argument('--dataset_dir', help='Directory containing images folder and label text files')
+parser.add_argument('--cache_features', type=bool, default=False,
+                    help='Train the head from cached features of the frozen layers')
+parser.add_argument('--feature_dir', help='Directory of the cached features, defaults to data_dir')
+parser.add_argument('--feature_dtype', default='float32', choices=['float32', 'float16'],
+                    help='Storage type of the cached features')
+parser.add_argument('--arena', type=bool, default=False,
+                    help='Keep the parameters of the tree nodes in contiguous arenas')
+parser.add_argument('--lazy_updates', type=bool, default=False,
+                    help='Only update the tree nodes each minibatch reaches, catching up the rest lazily')
+parser.add_argument('--eval_batches', type=int, default=None,
+                    help='Minibatches of the test set evaluated after each epoch, defaults to all')
+parser.add_argument('--depth_report', type=bool, default=False,
+                    help='Report the top 1 and top 5 accuracy of the tree at every depth')
+parser.add_argument('--profile', type=bool, default=False,
+                    help='Time the training phases and tree nodes and count host transfers')
 args = parser.parse_args()
+if args.cache_features and args.freeze == 0:
+    parser.error('--cache_features needs frozen layers, use --freeze')
+if args.lazy_updates and (not args.model_tree or args.fused):
+    parser.error('--lazy_updates needs the tree of classifiers, use --model_tree without --fused')
 
 # setup data provider
 train_set_options = dict(repo_dir=args.data_dir,
@@ -34,17 +64,45 @@ test_set_options = dict(repo_dir=args.data_dir,
                        dtype=args.datatype,
                        subset_pct=20)
 
-train = ImageLoader(set_name='train', **train_set_options)
+# Cached features are computed once, without the random crops and flips
+train = ImageLoader(set_name='train', do_transforms=not args.cache_features, **train_set_options)
 test = ImageLoader(set_name='train', do_transforms=False, **test_set_options)
 
 model, cost, opt = create_model(args.model_type, args.model_tree, args.freeze, args.dataset_dir,
-                                args.model_file, train)
+                                args.model_file, train, grouped=args.grouped,
+                                fused=args.fused, inference_mode=args.inference_mode,
+                                beam_width=args.beam_width, arena=args.arena)
+
+if args.cache_features:
+    feature_dir = os.path.expanduser(args.feature_dir or args.data_dir)
+    model_name = os.path.splitext(os.path.basename(args.model_file))[0]
+    loaders = []
+    for name, loader, opts in [('train', train, train_set_options),
+                               ('test', test, test_set_options)]:
+        prefix = os.path.join(feature_dir, '%s_%s_freeze%d_subset%d' % (
+            name, model_name, args.freeze, opts['subset_pct']))
+        extract_features(model.layers.layers, loader, prefix, dtype=args.feature_dtype)
+        loaders.append(FeatureLoader(prefix))
+    train, test = loaders
+    model = head_model(model, train)
 
 # configure callbacks
-valmetric = TopKMisclassification(k=5)
-valmetric.name = 'root_misclass'
+model.eval_max_batches = args.eval_batches
+model.lazy_updates = args.lazy_updates
+heads = [l for l in model.layers.layers if hasattr(l, 'ctree')]
+if args.depth_report and heads:
+    valmetric = DepthTopK(heads[0].ctree, ks=(1, 5))
+else:
+    valmetric = TopKMisclassification(k=5)
+    valmetric.name = 'root_misclass'
 # If freezing layers, load model in create_model
 if args.freeze > 0:
     args.callback_args['model_file'] = None
 callbacks = Callbacks(model, train, eval_set=test, metric=valmetric, **args.callback_args)
+if args.profile:
+    profiler = Profiler()
+    attach_profiler(model, profiler)
+    nodes = [n for n in heads[0].ctree.node_ids if n in heads[0].ctree.internalid_to_childrenid] \
+        if heads else None
+    callbacks.add_callback(ProfilerCallback(profiler, nodes=nodes))
 model.fit(train, optimizer=opt, num_epochs=args.epochs, cost=cost, callbacks=callbacks)